@@ -1,40 +1,214 @@
+import gc
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import (Flask, render_template, request, flash, redirect, session, g, jsonify, url_for, abort,
+                   stream_with_context, current_app)
+from flask.cli import AppGroup
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import configure_mappers, joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+import assets
+import fragments
+import current_user
+import live
+import metrics
+import directory
+import passwords
+import pools
+import profiling
+import replicas
+from replicas import replica_reads
+import search
+import instrumentation
+from instrumentation import query_budget
+import timeline
+from pagination import MAX_ID, PAGE_SIZE, before, cursor_from_request, split_page
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+# Most like/unlike operations one /api/likes request may carry.
+MAX_LIKES_BATCH = 100
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+# (rule, options, view) of every view, added to each app create_app makes
+ROUTES = []
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+# maintenance commands, added to each app's `flask` command
+commands = AppGroup('warbler')
 
-connect_db(app)
+
+def route(rule, **options):
+    """Register a view on the apps create_app makes, as app.route would."""
+
+    def decorator(view):
+        ROUTES.append((rule, options, view))
+        return view
+
+    return decorator
+
+
+def create_app(config=None):
+    """A Warbler app, configured from the environment and then `config`.
+
+    Making one connects to nothing: engines are created on first use. So
+    a prefork server can make the app in its master process, and with
+    PRELOAD set also `preload` it there, before forking workers:
+
+        PRELOAD=1 gunicorn --preload 'app:create_app()'
+
+    `app.startup_seconds` is how long this took.
+    """
+
+    start = time.perf_counter()
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Authors with more followers than this are merged into timelines at read
+    # time instead of being fanned out on write.
+    app.config['TIMELINE_FANOUT_LIMIT'] = int(
+        os.environ.get('TIMELINE_FANOUT_LIMIT', timeline.DEFAULT_FANOUT_LIMIT))
+
+    # Raise instead of logging when a view runs over its SQL query budget.
+    app.config['SQL_QUERY_BUDGET_STRICT'] = bool(
+        os.environ.get('SQL_QUERY_BUDGET_STRICT'))
+
+    # Seconds each process may reuse the logged-in user's record for g.user
+    # (0 to look it up on every request).
+    app.config['CURRENT_USER_CACHE_TTL'] = int(
+        os.environ.get('CURRENT_USER_CACHE_TTL', current_user.DEFAULT_TTL))
+
+    # bcrypt work factor for new password hashes; older hashes are upgraded as
+    # their users log in.
+    app.config['BCRYPT_LOG_ROUNDS'] = int(
+        os.environ.get('BCRYPT_LOG_ROUNDS', passwords.DEFAULT_ROUNDS))
+
+    # Processes hashing passwords off the request thread (0 to hash inline).
+    app.config['PASSWORD_HASH_WORKERS'] = int(
+        os.environ.get('PASSWORD_HASH_WORKERS', passwords.DEFAULT_WORKERS))
+
+    # Comma-separated URLs of read replicas for read-only GET views, and how
+    # long a client reads from the primary after writing (see replicas.py).
+    app.config['SQLALCHEMY_REPLICA_URLS'] = [
+        url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    app.config['REPLICA_STICKY_SECONDS'] = float(
+        os.environ.get('REPLICA_STICKY_SECONDS', replicas.DEFAULT_STICKY_SECONDS))
+
+    # Connection pool of each engine, per process (see pools.py).
+    app.config['DB_POOL_SIZE'] = int(
+        os.environ.get('DB_POOL_SIZE', pools.DEFAULT_POOL_SIZE))
+    app.config['DB_MAX_OVERFLOW'] = int(
+        os.environ.get('DB_MAX_OVERFLOW', pools.DEFAULT_MAX_OVERFLOW))
+    app.config['DB_POOL_RECYCLE'] = int(
+        os.environ.get('DB_POOL_RECYCLE', pools.DEFAULT_POOL_RECYCLE))
+    app.config['DB_POOL_TIMEOUT'] = float(
+        os.environ.get('DB_POOL_TIMEOUT', pools.DEFAULT_POOL_TIMEOUT))
+    app.config['DB_POOL_PRE_PING'] = (
+        os.environ.get('DB_POOL_PRE_PING', '1') != '0')
+
+    # Comma-separated addresses, besides the machine itself, that may scrape
+    # /metrics (see metrics.py).
+    app.config['METRICS_ALLOWED_ADDRESSES'] = metrics.LOCAL_ADDRESSES | {
+        address for address in os.environ.get('METRICS_ALLOWED_ADDRESSES', '').split(',')
+        if address}
+
+    # Fraction of requests to profile, and how (see profiling.py). Requests
+    # with a `flask profile-token` header are profiled too.
+    app.config['PROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    app.config['PROFILE_MODE'] = os.environ.get('PROFILE_MODE', 'sample')
+    if 'PROFILE_DIR' in os.environ:
+        app.config['PROFILE_DIR'] = os.environ['PROFILE_DIR']
+
+    # How live timeline events reach other worker processes: 'local' (one
+    # process) or 'socket' (through `flask live-broker`; see live.py).
+    app.config['LIVE_BACKEND'] = os.environ.get('LIVE_BACKEND', 'local')
+    app.config['LIVE_SOCKET'] = os.environ.get('LIVE_SOCKET', live.DEFAULT_SOCKET)
+
+    # Do the workers' one-off work in a prefork server's master (see preload).
+    app.config['PRELOAD'] = os.environ.get('PRELOAD', '0') != '0'
+
+    app.config.update(config or {})
+
+    if app.debug:
+        # for development only, and slow to import
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    pools.init_app(app)
+    connect_db(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    instrumentation.init_app(app)
+    replicas.init_app(app)
+    passwords.init_app(app)
+    assets.init_app(app)
+    fragments.init_app(app)
+    live.init_app(app)
+
+    app.before_request(add_user_to_g)
+    for rule, options, view in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_error_handler(404, page_not_found)
+    app.after_request(add_header)
+    for command in commands.commands.values():
+        app.cli.add_command(command)
+
+    if app.config['PRELOAD']:
+        preload(app)
+
+    app.startup_seconds = time.perf_counter() - start
+    return app
+
+
+def preload(app):
+    """Do the work each worker process would otherwise repeat on its first
+    requests: set up the ORM's mappers and compile every template.
+
+    Then freeze what is loaded out of the garbage collector's way, so
+    collections in forked workers don't touch (and copy) the pages they
+    share with the master.
+    """
+
+    configure_mappers()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    gc.freeze()
+
+
+def __getattr__(name):
+    """`app`, made from the environment on first use, for `from app import app`."""
+
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    globals()['app'] = create_app()
+    return globals()['app']
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    This is a cached, read-only record (see current_user.py); views that
+    change the user use `g.user.load()`.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = current_user.lookup(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -53,7 +227,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -89,7 +263,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -100,6 +274,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # keep any rehashed password
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -109,7 +285,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     """Handle logout of user."""
     do_logout()
@@ -120,45 +296,130 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@route('/users')
+@query_budget(4)
+@replica_reads
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    a 'page' param for later pages of results (see search.py).
+
+    Without a search, lists users a page at a time ('after' is the last
+    user id of the previous page), or all of them with 'stream' (see
+    directory.py).
     """
     form = MessageForm()
-    search = request.args.get('q')
+    text = request.args.get('q')
+    pages = {}
+
+    if text:
+        page = page_from_request()
+        users, has_more = search.search_users(text, page)
+        pages = search_page_urls('list_users', text, page, has_more)
+
+    elif request.args.get('stream'):
+        users = directory.all_users(g.user)
+        return current_app.response_class(
+            stream_with_context(stream_template('users/index.html', users=users, form=form)))
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        after = request.args.get('after', type=int)
+        if after is not None and not 0 <= after <= MAX_ID:
+            abort(400)
 
-    return render_template('users/index.html', users=users, form=form)
+        users, has_more = directory.users_page(after)
+        if has_more:
+            pages['next_url'] = url_for('list_users', after=users[-1].id)
+
+    if g.user:
+        g.user.follow_state.load(user.id for user in users)
 
+    return render_template('users/index.html', users=users, form=form, **pages)
 
-@app.route('/users/<int:user_id>')
+
+@route('/users/<int:user_id>')
+@query_budget(6)
+@replica_reads
 def users_show(user_id):
     """Show user profile."""
     form = MessageForm()
     user = User.query.get_or_404(user_id)
+    messages, next_cursor = user_messages_page(user_id)
+
+    return render_template('users/show.html', user=user, messages=messages, form=form,
+                           **load_more_urls(next_cursor, 'users_show', 'users_show_more', user_id=user_id))
+
+
+@route('/users/<int:user_id>/messages/more')
+@query_budget(4)
+@replica_reads
+def users_show_more(user_id):
+    """Next page of a user's messages, as list items for "load more"."""
+    User.query.get_or_404(user_id)
+    messages, next_cursor = user_messages_page(user_id)
+
+    return render_template('messages/items.html', messages=messages,
+                           **load_more_urls(next_cursor, 'users_show', 'users_show_more', user_id=user_id))
+
+
+def user_messages_page(user_id):
+    """One page of `user_id`'s messages, newest first, and the next cursor."""
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                # .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
+    query = (Message
+             .query
+             .options(joinedload(Message.user))
+             .filter(Message.user_id == user_id))
+    messages = (before(query, Message.timestamp, Message.id, cursor_from_request())
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(PAGE_SIZE + 1)
                 .all())
 
-    #getting all likes to be counted for like-count
-    all_likes = Likes.query.filter(Likes.user_id == user.id).all()
+    return split_page(messages)
 
-    return render_template('users/show.html', user=user, messages=messages, count=len(all_likes), form=form)
 
+def stream_template(template_name, **context):
+    """Render a template a few chunks at a time, as a response body."""
 
-@app.route('/users/<int:user_id>/following')
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+
+def page_from_request():
+    """The `page` number (from 1) of the current request."""
+
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400)
+    return page
+
+
+def search_page_urls(endpoint, q, page, has_more):
+    """Links to the pages of search results around `page`."""
+
+    urls = {}
+    if page > 1:
+        urls['prev_url'] = url_for(endpoint, q=q, page=page - 1)
+    if has_more:
+        urls['next_url'] = url_for(endpoint, q=q, page=page + 1)
+    return urls
+
+
+def load_more_urls(next_cursor, endpoint, more_endpoint, **values):
+    """Links to the page after `next_cursor`: as a full page, and as list items."""
+
+    if next_cursor is None:
+        return {}
+
+    return dict(next_url=url_for(endpoint, before=next_cursor, **values),
+                more_url=url_for(more_endpoint, before=next_cursor, **values))
+
+
+@route('/users/<int:user_id>/following')
+@query_budget(6)
+@replica_reads
 def show_following(user_id):
     """Show list of people this user is following."""
     form = MessageForm()
@@ -167,11 +428,13 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    all_likes = Likes.query.filter(Likes.user_id == user.id).all()
-    return render_template('users/following.html', user=user, form=form, count=len(all_likes))
+    g.user.follow_state.load(followed.id for followed in user.following)
+    return render_template('users/following.html', user=user, form=form)
 
 
-@app.route('/users/<int:user_id>/followers')
+@route('/users/<int:user_id>/followers')
+@query_budget(6)
+@replica_reads
 def users_followers(user_id):
     """Show list of followers of this user."""
     form = MessageForm()
@@ -180,11 +443,11 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    all_likes = Likes.query.filter(Likes.user_id == user.id).all()
-    return render_template('users/followers.html', user=user, form=form, count=len(all_likes))
+    g.user.follow_state.load(follower.id for follower in user.followers)
+    return render_template('users/followers.html', user=user, form=form)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -192,14 +455,24 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if not g.user.is_following(followed_user):
+        db.session.add(Follows(user_following_id=g.user.id,
+                               user_being_followed_id=follow_id))
+        db.session.flush()
+        timeline.follow_added(g.user.id, follow_id)
+        db.session.commit()
+        current_user.forget(g.user.id, follow_id)
+        live.announce_follow(g.user.id, follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -207,14 +480,21 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    removed = (Follows
+               .query
+               .filter(Follows.user_following_id == g.user.id,
+                       Follows.user_being_followed_id == follow_id)
+               .delete(synchronize_session=False))
+    if removed:
+        timeline.follow_removed(g.user.id, follow_id)
+        db.session.commit()
+        current_user.forget(g.user.id, follow_id)
+        live.announce_follow(g.user.id, follow_id, following=False)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
     
@@ -226,7 +506,8 @@ def profile():
     
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.password.data)
+        # g.user may be a few seconds stale; check against the stored user
+        user = User.authenticate(g.user.load().username, form.password.data)
          
         if user:
             user.username = form.username.data
@@ -237,6 +518,7 @@ def profile():
             
             db.session.add(user)
             db.session.commit()
+            current_user.forget(user.id)
             flash("Information updated", "success")
             return redirect (f'/users/{g.user.id}')
         else:
@@ -253,7 +535,7 @@ def profile():
 
 
 
-@app.route('/users/delete', methods=["POST"])
+@route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -263,8 +545,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    timeline.user_removed(g.user.id)
+    db.session.delete(g.user.load())
     db.session.commit()
+    current_user.forget(g.user.id)
 
     return redirect("/signup")
 
@@ -272,7 +556,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -286,9 +570,15 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.deliver_message(msg)
+        search.index_message(db.session, msg)
+        User.adjust_counts(g.user.id, messages=1)
         db.session.commit()
+        current_user.forget(g.user.id)
+        live.announce_message(msg.id, g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -329,16 +619,40 @@ def messages_add():
 
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@route('/messages/search')
+@query_budget(4)
+@replica_reads
+def messages_search():
+    """Search messages: 'q' is the words to look for, 'page' the page of
+    results, best match first (see search.py).
+    """
+    text = request.args.get('q', '')
+    page = page_from_request()
+    messages, has_more = search.search_messages(text, page)
+
+    template_vars = search_page_urls('messages_search', text, page, has_more)
+    if g.user:
+        template_vars['likes'] = g.user.liked_message_ids(messages)
+
+    return render_template('messages/search.html', messages=messages, q=text,
+                           **template_vars)
+
+
+@route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(4)
+@replica_reads
 def messages_show(message_id):
     """Show a message."""
     form = MessageForm()
 
-    msg = Message.query.get(message_id)
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
     return render_template('messages/show.html', message=msg, form=form)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -351,72 +665,272 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-
+    Message.release_counts(msg)
+    search.unindex_message(db.session, msg)
     db.session.delete(msg)
     db.session.commit()
+    current_user.forget(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
 ##############################################################################
 #Liking warbles
 
-@app.route("/users/add_like/<int:message_id>", methods=["POST"])
+@route("/users/add_like/<int:message_id>", methods=["POST"])
+@query_budget(2)
 def add_like(message_id):
-    """like warbles and add to liked list, handled with AJAX"""
+    """like warbles and add to liked list, handled with AJAX
+
+    Toggles the like in one statement (see `Likes.toggle`)."""
     if not g.user:
         flash("You must be logged in to like warbles", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(message_id)
-
-    if message not in g.user.likes:
-        """add a new like to the list"""
-        new_like = Likes(user_id=g.user.id, message_id=message_id)
-
-        db.session.add(new_like)
+    try:
+        liked = Likes.toggle(g.user.id, message_id)
         db.session.commit()
-        return "liked"
-    else:
-        """Delete a like"""
-        Likes.unlike(message_id)
-        return "unliked"
-    
+    except IntegrityError:
+        # no such message
+        db.session.rollback()
+        abort(404)
+
+    current_user.forget(g.user.id)
+    return "liked" if liked else "unliked"
 
 
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@route('/')
+@query_budget(8)
+@replica_reads
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages on the user's timeline, a page at a
+      time (see pagination.py)
     """
     form = MessageForm()
     if g.user:
-        likes = g.user.likes
-        following = g.user.following 
-        f_id = [ff.id for ff in following]
-        f_id.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(f_id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages, likes=likes, form=form)
+        messages, next_cursor = home_page()
+        likes = g.user.liked_message_ids(messages)
+
+        return render_template('home.html', messages=messages, likes=likes, form=form,
+                               **load_more_urls(next_cursor, 'homepage', 'homepage_more'))
 
     else:
         return render_template('home-anon.html')
 
-@app.errorhandler(404)
+
+@route('/timeline/more')
+@query_budget(8)
+@replica_reads
+def homepage_more():
+    """Next page of the home timeline, as list items for "load more"."""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    since_id = request.args.get('since_id', type=int)
+    if since_id is not None:
+        # messages newer than the page's, for live updates (see live.py)
+        if not 0 <= since_id <= MAX_ID:
+            abort(400)
+        messages = timeline.home_messages(g.user, limit=PAGE_SIZE, since_id=since_id)
+        likes = g.user.liked_message_ids(messages)
+        return render_template('messages/items.html', messages=messages, likes=likes)
+
+    messages, next_cursor = home_page()
+    likes = g.user.liked_message_ids(messages)
+
+    return render_template('messages/items.html', messages=messages, likes=likes,
+                           **load_more_urls(next_cursor, 'homepage', 'homepage_more'))
+
+
+@route('/timeline/stream')
+@query_budget(2)
+@replica_reads
+def timeline_stream():
+    """New messages on the home timeline as they are posted, as
+    Server-Sent Events (see live.py)."""
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    followed_ids = [followed_id for followed_id, in (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == g.user.id))]
+    # the stream holds this thread for as long as it is open, but it
+    # shouldn't hold a database connection too
+    db.session.close()
+
+    subscription = live.subscribe(g.user.id, followed_ids)
+    if subscription is None:
+        response = jsonify(error="Too many live streams; try again later.")
+        response.status_code = 503
+        response.headers['Retry-After'] = str(live.RETRY_MS // 1000)
+        return response
+
+    return live.event_stream(subscription)
+
+
+def home_page():
+    """One page of the current user's timeline and the next cursor."""
+
+    messages = timeline.home_messages(g.user, limit=PAGE_SIZE + 1,
+                                      cursor=cursor_from_request())
+    return split_page(messages)
+
+##############################################################################
+# JSON API
+
+@route('/api/timeline')
+@query_budget(6)
+@replica_reads
+def api_timeline():
+    """The current user's home timeline, as JSON.
+
+    Takes the same `before` cursor as the home page, or a `since_id` to
+    get only messages newer than one the client already has. Responses
+    carry an ETag (see `timeline.timeline_version`), so polling clients
+    get a 304 until something changes.
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    since_id = request.args.get('since_id', type=int)
+    if since_id is not None and not 0 <= since_id <= MAX_ID:
+        abort(400)
+    cursor = cursor_from_request()
+
+    follows_version, newest_id = timeline.timeline_version(g.user.id)
+    etag = (f"{g.user.id}-{follows_version}-{newest_id}-"
+            f"{since_id}-{request.args.get('before', '')}")
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        messages = timeline.home_messages(g.user, limit=PAGE_SIZE + 1,
+                                          cursor=cursor, since_id=since_id)
+        messages, next_cursor = split_page(messages)
+        response = jsonify(messages=[message_record(msg) for msg in messages],
+                           next_cursor=next_cursor)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def message_record(msg):
+    """A message, with its author, as a compact JSON-able dict."""
+
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user_id': msg.user_id,
+        'username': msg.user.username,
+        'image_url': msg.user.image_url,
+    }
+
+
+@route('/api/likes', methods=['POST'])
+@query_budget(6)
+def api_likes():
+    """Like and unlike several messages at once.
+
+    Takes `{"likes": [{"message_id": 1, "liked": true}, ...]}`; when a
+    message appears more than once, the last state wins, so clients can
+    queue up clicks and send them together. All of them are applied in one
+    transaction, and the response has the resulting state of each message
+    (messages that don't exist are left out).
+    """
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    operations = (request.get_json(silent=True) or {}).get('likes')
+    if not isinstance(operations, list) or len(operations) > MAX_LIKES_BATCH:
+        abort(400)
+
+    wanted = {}
+    for operation in operations:
+        message_id = operation.get('message_id') if isinstance(operation, dict) else None
+        liked = operation.get('liked') if isinstance(operation, dict) else None
+        if (type(message_id) is not int or not 0 < message_id <= MAX_ID
+                or type(liked) is not bool):
+            abort(400)
+        wanted[message_id] = liked
+
+    states = Likes.set_likes(g.user.id, wanted)
+    db.session.commit()
+    current_user.forget(g.user.id)
+
+    return jsonify(likes=[{'message_id': message_id, 'liked': liked}
+                          for message_id, liked in states.items()])
+
+
 def page_not_found(e):
     return render_template('404.html'), 404
 
 
+##############################################################################
+# Maintenance commands
+
+@commands.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's home timeline from follows and messages."""
+
+    timeline.rebuild_timelines()
+    db.session.commit()
+
+
+@commands.command('reconcile-counts')
+def reconcile_counts_command():
+    """Recompute every user's message, follow and like counts."""
+
+    User.reconcile_counts()
+    db.session.commit()
+
+
+@commands.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = assets.build(current_app.static_folder, current_app.config['ASSETS_DIR'])
+    print(f"Built {len(manifest)} assets into {current_app.config['ASSETS_DIR']}")
+
+
+@commands.command('profile-token')
+def profile_token_command():
+    """Print a request header that has the request profiled."""
+
+    print(f"{current_app.config['PROFILE_HEADER']}: {profiling.make_token(current_app)}")
+
+
+@commands.command('live-broker')
+def live_broker_command():
+    """Relay live timeline events between worker processes."""
+
+    live.run_broker(current_app.config['LIVE_SOCKET'])
+
+
+@commands.command('create-search-index')
+def create_search_index_command():
+    """Add the user and message search indexes to an existing database."""
+
+    search.create_search_index(db.session)
+    db.session.commit()
+
+
+@commands.command('reindex-messages')
+def reindex_messages_command():
+    """Rebuild the message search index (a no-op on PostgreSQL)."""
+
+    search.reindex_messages(db.session)
+    db.session.commit()
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -424,9 +938,16 @@ def page_not_found(e):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to dynamic HTML pages.
+
+    Other responses keep their own caching: static files are revalidated,
+    fingerprinted assets are immutable (see assets.py), and views like
+    the JSON API set their own.
+    """
+
+    if req.mimetype != 'text/html' or 'Cache-Control' in req.headers:
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
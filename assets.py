@@ -0,0 +1,178 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ to static/dist/ with
+a hash of its contents in the name (style.css -> style.3f2a9c1b0e.css),
+writes gzip and, if the `brotli` package is installed, brotli versions of
+the text files next to them, and records the names in
+static/dist/manifest.json. Stylesheets have their url("/static/...")
+references rewritten to the hashed files.
+
+Templates link to assets with `asset_url('likes.js')`. With a manifest,
+that is a /assets/ URL for the hashed file, served in the best encoding
+the browser accepts and cached for a year: a changed file gets a new
+name, so nothing is ever stale. Without one (e.g. in development), it is
+the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import abort, current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+ASSETS_URL = '/assets/'
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.html', '.ico'}
+
+# (encoding, file suffix), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_URL = re.compile(r'''url\((["']?)/static/([^"')]+)\1\)''')
+
+
+def init_app(app):
+    """Serve built assets and add `asset_url` to `app`'s templates."""
+
+    app.config.setdefault('ASSETS_DIR',
+                          os.path.join(app.static_folder, DIST_DIR))
+    app.extensions['assets'] = load_manifest(app.config['ASSETS_DIR'])
+
+    app.add_url_rule(ASSETS_URL + '<path:filename>', 'assets', serve_asset)
+    app.add_template_global(asset_url)
+
+
+def load_manifest(dist_dir):
+    """The {static path: hashed path} manifest in `dist_dir`, or {}."""
+
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(path):
+    """URL of the static file `path`, fingerprinted if assets are built."""
+
+    hashed = current_app.extensions['assets'].get(path)
+    if hashed is None:
+        return url_for('static', filename=path)
+
+    return url_for('assets', filename=hashed)
+
+
+def serve_asset(filename):
+    """A built asset, precompressed if the browser accepts it."""
+
+    if filename not in current_app.extensions['assets'].values():
+        abort(404)
+
+    dist_dir = current_app.config['ASSETS_DIR']
+    mimetype = _mimetype(filename)
+
+    for encoding, suffix in ENCODINGS:
+        if (encoding in request.accept_encodings
+                and os.path.exists(os.path.join(dist_dir, filename + suffix))):
+            response = send_from_directory(dist_dir, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(dist_dir, filename, mimetype=mimetype)
+
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def build(static_dir, dist_dir=None):
+    """Fingerprint and compress everything under `static_dir` into
+    `dist_dir` (static/dist by default). Returns the manifest.
+    """
+
+    dist_dir = dist_dir or os.path.join(static_dir, DIST_DIR)
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+
+    paths = sorted(_static_files(static_dir, dist_dir),
+                   key=lambda path: path.endswith('.css'))
+
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            content = f.read()
+
+        # stylesheets go last, so the files they refer to are hashed
+        if path.endswith('.css'):
+            content = _rewrite_css(content, manifest)
+
+        hashed = _hashed_name(path, content)
+        _write(dist_dir, hashed, content)
+        manifest[path] = hashed
+
+    with open(os.path.join(dist_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def _static_files(static_dir, dist_dir):
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs
+                   if os.path.join(root, d) != dist_dir]
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_dir)
+            yield path.replace(os.sep, '/')
+
+
+def _hashed_name(path, content):
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.{digest}{ext}"
+
+
+def _rewrite_css(content, manifest):
+    def replace(match):
+        hashed = manifest.get(match.group(2))
+        if hashed is None:
+            return match.group(0)
+        return f'url("{ASSETS_URL}{hashed}")'
+
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def _write(dist_dir, path, content):
+    target = os.path.join(dist_dir, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with open(target, 'wb') as f:
+        f.write(content)
+
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+
+    # mtime=0 keeps builds byte-for-byte reproducible
+    with open(target + '.gz', 'wb') as f:
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+    if brotli is not None:
+        with open(target + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -0,0 +1,300 @@
+"""Benchmark the main routes against generated data sets of several sizes.
+
+    python benchmark.py                          # 1000 and 10000 users
+    python benchmark.py --sizes 1000,100000 --requests 200 --out run.json
+    python benchmark.py --baseline run.json      # and compare with an earlier run
+
+For each size, generator/create_csvs.py writes a data set (the same one
+every time, for the same size and --seed), seed.py loads it into
+BENCHMARK_DATABASE_URL, and each route is requested through the test
+client, logged in, --requests times. The user who follows the most users
+views the pages; the most followed user is the one whose pages they view.
+
+Per route, results have p50/p95/p99 latency, SQL statements per request
+and the peak memory Python allocated while serving one request (measured
+in a separate pass, since tracemalloc slows everything down). They are
+written as JSON; with --baseline, routes whose p95 latency or statement
+count grew by more than --threshold are listed, and the exit status is 1.
+
+Cold start is measured too, in --startup-runs fresh processes: the time
+to import app.py, to create_app(), and to serve a first request, and
+the whole process's wall time. Their medians are compared with the
+baseline's in the same way.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCHMARK_DATABASE_URL', 'postgresql:///warbler_benchmark')
+
+# Now we can import app
+
+from sqlalchemy import event
+
+from app import app, db, CURR_USER_KEY
+from models import User, Message, Follows
+import current_user
+import seed
+
+SIZES = [1000, 10000]
+REQUESTS = 100
+WARMUP = 5
+MEMORY_REQUESTS = 5
+THRESHOLD = 1.2
+STARTUP_RUNS = 5
+
+MESSAGES_PER_USER = 5
+FOLLOWS_PER_USER = 20
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GENERATOR = os.path.join(HERE, 'generator', 'create_csvs.py')
+
+# run in a fresh process; prints the times of each startup step, in ms
+STARTUP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+application.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000}))
+'''
+
+
+def routes(viewer_id, target_id, message_id):
+    """(name, method, url) of each route to measure."""
+
+    return [
+        ('homepage', 'GET', '/'),
+        ('users_show', 'GET', f'/users/{target_id}'),
+        ('show_following', 'GET', f'/users/{viewer_id}/following'),
+        ('users_followers', 'GET', f'/users/{target_id}/followers'),
+        ('add_like', 'POST', f'/users/add_like/{message_id}'),
+        ('list_users', 'GET', '/users'),
+    ]
+
+
+class StatementCounter:
+    """Counts the SQL statements run on `engine`."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def percentile(values, p):
+    """The `p`th percentile of `values`, by nearest rank."""
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def load(size, options, workdir):
+    """Generate and seed the data set for `size` users."""
+
+    subprocess.run(
+        [sys.executable, GENERATOR,
+         '--users', str(size),
+         '--messages', str(size * options.messages_per_user),
+         '--follows', str(size * options.follows_per_user),
+         '--seed', options.seed,
+         '--out', workdir],
+        check=True, stdout=subprocess.DEVNULL)
+
+    seed.SOURCES = [(os.path.join(workdir, f'{kind}*.csv'), table)
+                    for kind, table in [('users', User.__table__),
+                                        ('messages', Message.__table__),
+                                        ('follows', Follows.__table__)]]
+    seed.seed()
+    current_user.clear()
+
+
+def pick_users():
+    """The user following the most users, the most followed user, and a
+    message of the latter's for the viewer to like."""
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    target = User.query.order_by(User.followers_count.desc(), User.id).first()
+    message = (Message
+               .query
+               .filter(Message.user_id == target.id)
+               .order_by(Message.id)
+               .first())
+    return viewer.id, target.id, message.id if message else 1
+
+
+def measure(client, method, url, requests, counter, warmup=WARMUP,
+            memory_requests=MEMORY_REQUESTS):
+    """Latency percentiles, statements per request and peak memory for `url`."""
+
+    for _ in range(warmup):
+        client.open(url, method=method)
+
+    timings = []
+    statements = []
+    for _ in range(requests):
+        before = counter.count
+        start = time.perf_counter()
+        resp = client.open(url, method=method)
+        timings.append((time.perf_counter() - start) * 1000)
+        statements.append(counter.count - before)
+
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{method} {url} returned {resp.status_code}")
+
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(memory_requests):
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            client.open(url, method=method)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - held)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'statements': max(statements),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def measure_startup(runs=STARTUP_RUNS):
+    """Median cold-start times over `runs` fresh processes."""
+
+    steps = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=HERE,
+                                check=True, stdout=subprocess.PIPE).stdout
+        times = json.loads(output.decode().splitlines()[-1])
+        times['process_ms'] = (time.perf_counter() - start) * 1000
+        for step, ms in times.items():
+            steps.setdefault(step, []).append(ms)
+
+    return {step: round(percentile(values, 50), 3)
+            for step, values in steps.items()}
+
+
+def run(options):
+    """Benchmark every route at every size; the results, as a dict."""
+
+    startup = measure_startup(options.startup_runs)
+    print("startup  " + "  ".join(f"{step} {ms:.1f}" for step, ms in startup.items()))
+
+    counter = StatementCounter(db.engine)
+    results = []
+
+    for size in options.sizes:
+        # end the last size's transaction, whose locks would block the reseed
+        db.session.remove()
+
+        with tempfile.TemporaryDirectory() as workdir:
+            load(size, options, workdir)
+
+        viewer_id, target_id, message_id = pick_users()
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_id
+
+        for name, method, url in routes(viewer_id, target_id, message_id):
+            result = measure(client, method, url, options.requests, counter)
+            result.update(size=size, route=name)
+            results.append(result)
+            print(f"{size:>10} users  {name:<16} p50 {result['p50_ms']:8.2f}ms  "
+                  f"p95 {result['p95_ms']:8.2f}ms  p99 {result['p99_ms']:8.2f}ms  "
+                  f"{result['statements']:3} statements  "
+                  f"{result['peak_memory_kb']:8.1f}KB")
+
+    return {
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'database': db.engine.dialect.name,
+        'seed': options.seed,
+        'startup': startup,
+        'results': results,
+    }
+
+
+def compare(run, baseline, threshold=THRESHOLD):
+    """Descriptions of the results in `run` that regressed from `baseline`."""
+
+    old = {(result['size'], result['route']): result
+           for result in baseline['results']}
+    regressions = []
+
+    for result in run['results']:
+        before = old.get((result['size'], result['route']))
+        if before is None:
+            continue
+
+        for key in ('p95_ms', 'statements'):
+            if result[key] > before[key] * threshold:
+                regressions.append(
+                    f"{result['route']} at {result['size']} users: "
+                    f"{key} {before[key]} -> {result[key]}")
+
+    startup, before = run.get('startup', {}), baseline.get('startup', {})
+    for step, ms in startup.items():
+        if step in before and ms > before[step] * threshold:
+            regressions.append(f"startup: {step} {before[step]} -> {ms}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        type=lambda sizes: [int(size) for size in sizes.split(',')],
+                        help="comma-separated numbers of users")
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help="timed requests per route")
+    parser.add_argument('--messages-per-user', type=int, default=MESSAGES_PER_USER)
+    parser.add_argument('--follows-per-user', type=int, default=FOLLOWS_PER_USER)
+    parser.add_argument('--seed', default='benchmark')
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS,
+                        help="fresh processes to time startup in")
+    parser.add_argument('--out', default='benchmark.json',
+                        help="file to write results to")
+    parser.add_argument('--baseline',
+                        help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="ratio over the baseline that counts as a regression")
+    options = parser.parse_args()
+
+    with app.app_context():
+        results = run(options)
+
+    with open(options.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {options.out}")
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,107 @@
+"""Cached records of the logged-in user, for `g.user`.
+
+Every request needs the current user (for the navbar, if nothing else), but
+few need them as an ORM object. `lookup(user_id)` returns a `CurrentUser`
+built from a small per-process cache, so most requests don't touch the
+database to fill in `g.user`.
+
+Entries live for CURRENT_USER_CACHE_TTL seconds (0 turns the cache off) and
+the least recently used are dropped past CURRENT_USER_CACHE_SIZE. Views that
+change what a record holds (profile edits, follows, posts, likes) call
+`forget()` for the users involved; changes made in other processes show up
+once the entry expires.
+
+Views that change the user themselves call `g.user.load()` for the full
+`User`.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from models import db, User, ViewerMixin
+
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 10000
+
+FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+          'location', 'messages_count', 'following_count', 'followers_count',
+          'likes_count')
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class CurrentUser(ViewerMixin):
+    """Read-only copy of a user's profile and counts.
+
+    Compares equal to the `User` (or `CurrentUser`) with the same id.
+    """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def __eq__(self, other):
+        if isinstance(other, (User, CurrentUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def load(self):
+        """The full `User` this record was made from."""
+
+        return User.query.get(self.id)
+
+
+def lookup(user_id):
+    """A `CurrentUser` for `user_id`, or None if there is no such user."""
+
+    ttl = current_app.config.get('CURRENT_USER_CACHE_TTL', DEFAULT_TTL)
+    now = time.monotonic()
+
+    with _lock:
+        entry = _cache.get(user_id)
+        if entry is not None and entry[0] > now:
+            _cache.move_to_end(user_id)
+            return CurrentUser(**entry[1])
+
+    row = (db.session
+           .query(*(getattr(User, field) for field in FIELDS))
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        return None
+
+    fields = dict(zip(FIELDS, row))
+
+    if ttl > 0:
+        size = current_app.config.get('CURRENT_USER_CACHE_SIZE', DEFAULT_SIZE)
+        with _lock:
+            _cache[user_id] = (now + ttl, fields)
+            _cache.move_to_end(user_id)
+            while len(_cache) > size:
+                _cache.popitem(last=False)
+
+    return CurrentUser(**fields)
+
+
+def forget(*user_ids):
+    """Drop the cached records of `user_ids`."""
+
+    with _lock:
+        for user_id in user_ids:
+            _cache.pop(user_id, None)
+
+
+def clear():
+    """Drop every cached record."""
+
+    with _lock:
+        _cache.clear()
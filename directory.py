@@ -0,0 +1,55 @@
+"""The /users directory, a page at a time or streamed.
+
+Pages are keyset-paginated on user id (`?after=<last id on the page>`),
+so each is one index range read however deep it is. The streamed listing
+(`?stream=1`) reads every user through a server-side cursor, a batch at a
+time, and the page is sent as it renders; neither keeps the whole user
+table in memory.
+"""
+
+from itertools import islice
+
+from sqlalchemy.orm import load_only
+
+from models import User
+from search import CARD_COLUMNS, USERS_PER_PAGE
+
+STREAM_BATCH_SIZE = 500
+
+
+def users_page(after=None, per_page=USERS_PER_PAGE):
+    """The `per_page` users after id `after`, and whether there are more."""
+
+    query = User.query.options(load_only(*CARD_COLUMNS))
+    if after is not None:
+        query = query.filter(User.id > after)
+
+    users = query.order_by(User.id).limit(per_page + 1).all()
+    return users[:per_page], len(users) > per_page
+
+
+def all_users(viewer=None, batch_size=STREAM_BATCH_SIZE):
+    """Every user, in id order, read `batch_size` at a time.
+
+    If there is a `viewer`, their follow state is looked up for each
+    batch before it is yielded, so templates can ask about it for free.
+    """
+
+    users = (User
+             .query
+             .options(load_only(*CARD_COLUMNS))
+             .order_by(User.id)
+             .yield_per(batch_size))
+
+    users = iter(users)
+    while True:
+        batch = list(islice(users, batch_size))
+        if not batch:
+            return
+
+        if viewer is not None:
+            # one batch's state at a time, not every user's
+            viewer.forget_follow_state()
+            viewer.follow_state.load(user.id for user in batch)
+
+        yield from batch
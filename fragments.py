@@ -0,0 +1,106 @@
+"""Cache of rendered message cards.
+
+A message's card (its author's avatar and name, timestamp and text; see
+templates/messages/card.html) only changes when the author changes their
+username or picture, and messages are never edited, so each card is
+rendered once and reused from a per-process LRU cache keyed on exactly
+those fields. (The message's timestamp is part of the key too, so a
+reset database that hands out old ids again can't show stale cards.)
+Anything viewer-specific, like the like button, is rendered around the
+card by messages/items.html.
+
+The cache holds at most FRAGMENT_CACHE_BYTES of HTML; the least recently
+used cards are dropped first.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+
+CARD_TEMPLATE = 'messages/card.html'
+
+
+class FragmentCache:
+    """Thread-safe LRU cache of HTML strings, bounded by total size."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The fragment stored under `key`, or None."""
+
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+
+    def set(self, key, html):
+        """Store `html` under `key`, evicting old fragments to make room.
+
+        Fragments bigger than a tenth of the cache aren't kept.
+        """
+
+        size = len(html)
+        if size > self.max_bytes // 10:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._entries[key] = html
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """Drop every fragment, and start counting hits and misses afresh."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def init_app(app):
+    """Add `message_card` to `app`'s templates, with its own cache."""
+
+    app.config.setdefault('FRAGMENT_CACHE_BYTES', DEFAULT_MAX_BYTES)
+    app.extensions['fragments'] = FragmentCache(
+        app.config['FRAGMENT_CACHE_BYTES'])
+    app.add_template_global(message_card)
+
+
+def message_card(msg):
+    """The card for `msg`, from the cache if it has been rendered before."""
+
+    cache = current_app.extensions['fragments']
+    key = (msg.id, msg.timestamp, msg.user.username, msg.user.image_url)
+
+    html = cache.get(key)
+    if html is None:
+        html = current_app.jinja_env.get_template(CARD_TEMPLATE).render(msg=msg)
+        cache.set(key, html)
+
+    return Markup(html)
@@ -3,28 +3,62 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py         # 300 users, 1000 messages, 5000 follows
+    python generator/create_csvs.py --users 10000000 --messages 100000000 \\
+        --follows 1000000000 --shards 512 --workers 16
+
+The same --seed always gives the same files, and nothing is fetched from
+the network. With more than one shard, each table is split by id range
+into users-0000.csv, users-0001.csv, ... each written by its own process;
+seed.py loads either layout.
+
+Who follows whom is sampled a follower at a time, so memory doesn't grow
+with the number of users: how many users each user follows is heavy
+tailed, and who they follow is drawn from a power law, so a few users
+have a huge share of all followers and most have a handful. Messages are
+spread over authors the same way.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+from datetime import datetime
+from functools import lru_cache
+from glob import glob
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import PowerLaw, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+
+# P(k-th most followed user) ~ 1 / k**POPULARITY_EXPONENT; same for authors
+POPULARITY_EXPONENT = 1.1
+
+# Pareto shape of how many users each user follows (lower: heavier tail)
+FOLLOWING_SHAPE = 1.5
+
+# distinct names, sentences etc. drawn from Faker for rows to be built from
+POOL_SIZE = 5000
 
-fake = Faker()
+# messages are dated in the two years before this, unless --end says otherwise
+END = datetime(2020, 1, 1)
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +66,197 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+with open(os.path.join(GENERATOR_DIR, 'header_images.txt')) as f:
+    header_image_urls = f.read().split()
+
+
+def shard_random(options, kind, shard):
+    """The random generator for one shard: the same for the same seed."""
+
+    return random.Random(f"{options.seed}:{kind}:{shard}")
+
+
+@lru_cache()
+def pools(seed):
+    """Names, cities, sentences etc. to build rows from: the same for the same seed.
+
+    Faker is far too slow to call per row at millions of rows, so each
+    process asks it for a few thousand of each once.
+    """
+
+    fake = Faker()
+    fake.seed_instance(f"{seed}:pools")
+
+    return dict(
+        first_names=[fake.first_name().lower() for _ in range(POOL_SIZE)],
+        last_names=[fake.last_name().lower() for _ in range(POOL_SIZE)],
+        domains=sorted({fake.free_email_domain() for _ in range(100)}),
+        cities=[fake.city() for _ in range(POOL_SIZE)],
+        sentences=[fake.sentence() for _ in range(POOL_SIZE)],
+    )
+
+
+def write_users(writer, rng, lo, hi, options):
+    words = pools(options.seed)
+
+    for user_id in range(lo, hi):
+        # the id suffix keeps usernames and emails unique at any size
+        username = (f"{rng.choice(words['first_names'])}"
+                    f"{rng.choice(words['last_names'])}{user_id}")
+        writer.writerow([
+            user_id,
+            f"{username}@{rng.choice(words['domains'])}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            rng.choice(words['sentences']),
+            rng.choice(header_image_urls),
+            rng.choice(words['cities']),
+        ])
+
+
+def write_messages(writer, rng, lo, hi, options):
+    words = pools(options.seed)
+    authors = PowerLaw(options.users, POPULARITY_EXPONENT, f"{options.seed}:authors")
+
+    for message_id in range(lo, hi):
+        text = ' '.join(rng.choices(words['sentences'], k=rng.randint(1, 4)))
+        writer.writerow([
+            message_id,
+            text[:MAX_WARBLER_LENGTH],
+            get_random_datetime(now=options.end, rng=rng),
+            authors.draw(rng),
+        ])
+
+
+def write_follows(writer, rng, lo, hi, options):
+    users = options.users
+    popular = PowerLaw(users, POPULARITY_EXPONENT, f"{options.seed}:popularity")
+
+    # this shard's share of --follows, handed out to its followers in
+    # proportion to heavy-tailed weights, so the shards' totals add up to it
+    budget = follows_before(hi, options) - follows_before(lo, options)
+    weights = [rng.paretovariate(FOLLOWING_SHAPE) for _ in range(lo, hi)]
+    total = sum(weights)
+
+    running = 0
+    given = 0
+    for follower, weight in zip(range(lo, hi), weights):
+        running += weight
+        target = budget if follower == hi - 1 else int(budget * running / total)
+        count = target - given
+        given += count
+        count = min(count, users - 1)
+
+        followed = set()
+        draws = 0
+        while len(followed) < count:
+            # near-complete follow lists run out of popular users to draw,
+            # so finish them uniformly
+            if draws < 20 * count:
+                user = popular.draw(rng)
+            else:
+                user = rng.randint(1, users)
+            draws += 1
+            if user != follower:
+                followed.add(user)
+
+        writer.writerows([user, follower] for user in followed)
+
+
+def follows_before(user_id, options):
+    """How many follows the followers with ids below `user_id` make between them."""
+
+    return options.follows * (user_id - 1) // options.users
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, lambda options: options.users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, lambda options: options.messages),
+    # follows are split by follower
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, lambda options: options.users),
+}
+
+
+def shard_path(options, kind, shard):
+    if options.shards == 1:
+        return os.path.join(options.out, f'{kind}.csv')
+    return os.path.join(options.out, f'{kind}-{shard:04}.csv')
+
+
+def shard_tasks(options):
+    """(kind, shard, first id, last id + 1) for every shard of every table."""
+
+    for kind, (_, _, size) in TABLES.items():
+        count = size(options)
+        for shard in range(options.shards):
+            lo = count * shard // options.shards + 1
+            hi = count * (shard + 1) // options.shards + 1
+            yield kind, shard, lo, hi
+
+
+def write_shard(task, options):
+    kind, shard, lo, hi = task
+    headers, write, _ = TABLES[kind]
+    path = shard_path(options, kind, shard)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        write(writer, shard_random(options, kind, shard), lo, hi, options)
+
+    return path
+
+
+def _write_shard(args):
+    return write_shard(*args)
+
+
+def generate(options):
+    """Write every shard of every table, `options.workers` at a time."""
+
+    # drop files left by a run with a different number of shards
+    for kind in TABLES:
+        for path in glob(os.path.join(options.out, f'{kind}.csv')) + \
+                glob(os.path.join(options.out, f'{kind}-*.csv')):
+            os.remove(path)
+
+    tasks = [(task, options) for task in shard_tasks(options)]
+
+    if options.workers == 1:
+        done = map(_write_shard, tasks)
+    else:
+        pool = Pool(options.workers)
+        done = pool.imap_unordered(_write_shard, tasks)
+
+    for path in done:
+        print(path)
+
+    if options.workers != 1:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', default='warbler',
+                        help="the same seed gives the same files")
+    parser.add_argument('--end', type=datetime.fromisoformat, default=END,
+                        help="date messages are dated up to")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="files to split each table into")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes writing shards")
+    parser.add_argument('--out', default=GENERATOR_DIR,
+                        help="directory to write the CSVs to")
+    options = parser.parse_args()
+
+    if options.users < 2:
+        parser.error("--users must be at least 2")
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+    generate(options)
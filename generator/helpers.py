@@ -1,14 +1,54 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the `year_gap` years before `now`."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class PowerLaw:
+    """Draw ids 1..n, where the k-th most popular id is drawn ~ 1 / k**exponent.
+
+    Ranks are drawn by inverting the continuous power-law CDF, so a draw
+    is O(1) and nothing of size n is kept. Ranks map to ids through an
+    affine permutation, `(a * rank + b) % n`, so the popular ids are
+    scattered rather than the lowest ones. The permutation depends only
+    on `seed`, so every process building one gets the same.
+    """
+
+    def __init__(self, n, exponent, seed):
+        self.n = n
+        self.exponent = exponent
+
+        rng = random.Random(seed)
+        self.a = rng.randrange(1, n + 1) if n > 1 else 1
+        while gcd(self.a, n) != 1:
+            self.a += 1
+        self.b = rng.randrange(n)
+
+        self._power = 1 - exponent
+        self._span = (n + 1) ** self._power - 1
+
+    def rank(self, rng):
+        """A rank from 0 (most popular) to n - 1."""
+
+        u = rng.random()
+        if self._power == 0:
+            x = (self.n + 1) ** u
+        else:
+            x = (1 + u * self._span) ** (1 / self._power)
+        return min(int(x), self.n) - 1
+
+    def draw(self, rng):
+        """An id from 1 to n."""
+
+        return (self.a * self.rank(rng) + self.b) % self.n + 1
@@ -0,0 +1,150 @@
+"""Per-request SQL statement counting and query budgets.
+
+Every statement run through SQLAlchemy during a request is counted (via
+engine events, so this covers every engine the app uses). A view can
+declare how many statements it should need:
+
+    @app.route('/')
+    @query_budget(8)
+    def homepage():
+        ...
+
+When a request runs more statements than its view's budget, it is logged
+as a warning, or, with SQL_QUERY_BUDGET_STRICT set (as the tests do),
+raises QueryBudgetExceeded so N+1 regressions fail loudly.
+
+With SQL_EXPLAIN_CHECK set (a test mode, PostgreSQL only), every statement
+a request runs is first EXPLAINed with sequential scans disabled, which
+leaves a Seq Scan in the plan only where no index can serve the query.
+A request whose plans scan any of SQL_EXPLAIN_TABLES that way raises
+SequentialScan.
+"""
+
+import logging
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+# tables that grow with the number of users, which no request should scan
+LARGE_TABLES = frozenset({
+    'users', 'messages', 'follows', 'likes', 'timelines', 'message_terms',
+})
+
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL statements than its view's budget."""
+
+
+class SequentialScan(Exception):
+    """A request ran a statement that can only scan a whole large table."""
+
+
+def init_app(app):
+    """Count statements in `app`'s requests and check them against budgets.
+
+    Call this before registering other before_request hooks, so their
+    statements are counted too.
+    """
+
+    app.config.setdefault('SQL_QUERY_BUDGET_STRICT', False)
+    app.config.setdefault('SQL_EXPLAIN_CHECK', False)
+    app.config.setdefault('SQL_EXPLAIN_TABLES', LARGE_TABLES)
+    app.before_request(start_counting)
+    app.after_request(check_budget)
+    app.after_request(check_plans)
+
+
+def query_budget(limit):
+    """Declare that a view should run at most `limit` SQL statements."""
+
+    def decorator(view):
+        view.query_budget = limit
+        return view
+
+    return decorator
+
+
+def statement_count():
+    """Number of SQL statements run so far in the current request."""
+
+    return g.get('sql_statements', 0)
+
+
+def start_counting():
+    g.sql_statements = 0
+
+
+def check_budget(response):
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    count = statement_count()
+
+    if budget is not None and count > budget:
+        message = (f"{request.endpoint} ran {count} SQL statements, "
+                   f"over its budget of {budget}")
+        if current_app.config['SQL_QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    return response
+
+
+def check_plans(response):
+    scans = g.get('sql_seq_scans')
+    if scans:
+        table, statement = scans[0]
+        raise SequentialScan(f"{request.endpoint} scans {table} sequentially "
+                             f"in: {statement}")
+
+    return response
+
+
+def sequential_scans(plan, tables):
+    """Tables among `tables` that an EXPLAIN (FORMAT JSON) `plan` node, or
+    any below it, reads with a Seq Scan."""
+
+    scans = []
+    if plan['Node Type'] == 'Seq Scan' and plan['Relation Name'] in tables:
+        scans.append(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        scans.extend(sequential_scans(child, tables))
+    return scans
+
+
+def _explain(conn, statement, parameters):
+    """Record the large tables `statement` can only scan sequentially."""
+
+    if (conn.dialect.name != 'postgresql'
+            or not statement.lstrip().upper().startswith(EXPLAINABLE)):
+        return
+
+    # a cursor of its own, so the statement's results aren't disturbed
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        [plan] = cursor.fetchone()[0]
+    finally:
+        cursor.execute("RESET enable_seqscan")
+        cursor.close()
+
+    tables = current_app.config['SQL_EXPLAIN_TABLES']
+    scans = g.setdefault('sql_seq_scans', [])
+    scans.extend((table, statement)
+                 for table in sequential_scans(plan['Plan'], tables))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if has_request_context():
+        g.sql_statements = g.get('sql_statements', 0) + 1
+
+        if current_app.config.get('SQL_EXPLAIN_CHECK') and not executemany:
+            _explain(conn, statement, parameters)
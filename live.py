@@ -0,0 +1,372 @@
+"""Live timeline updates, pushed to browsers as Server-Sent Events.
+
+When a message is posted, its id is published on its author's channel;
+each open /timeline/stream is subscribed to the channels of the user it
+is for and of everyone they follow, and passes the ids on as `message`
+events. The page then fetches the new messages itself (see
+static/live.js). Follows and unfollows are published too, so open
+streams pick up the change without reconnecting.
+
+Events go through a backend, chosen by LIVE_BACKEND:
+
+- 'local' delivers them to this process's streams only, which suits a
+  single worker process.
+- 'socket' sends them to a broker on the unix socket LIVE_SOCKET, which
+  relays them to every worker process that is connected to it. Run the
+  broker with `flask live-broker`.
+
+Each stream has a heartbeat comment every LIVE_HEARTBEAT seconds, which
+keeps proxies from timing it out and finds clients that have gone away.
+Backpressure is handled by dropping work, never by making anyone wait:
+
+- a stream whose client falls more than LIVE_QUEUE_SIZE events behind
+  loses them, and gets a `reset` event telling it to catch up from
+  /timeline/more instead;
+- a process serves at most LIVE_MAX_STREAMS streams, and answers more
+  with 503 and a Retry-After (each stream holds a worker thread);
+- the broker drops a worker that stops reading. The worker reconnects,
+  and its streams are reset.
+
+Delivery is best effort: with the broker down, posting still works, but
+open streams see nothing until it is back.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('local', 'socket')
+
+DEFAULT_HEARTBEAT = 15
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_STREAMS = 100
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'warbler-live.sock')
+
+# how long browsers wait before reconnecting a dropped stream, in ms
+RETRY_MS = 3000
+
+# most bytes the broker will buffer for a worker before dropping it
+BROKER_BUFFER = 1024 * 1024
+
+RESET = object()
+
+
+class Subscription:
+    """One stream's channels, and the events on them it hasn't sent yet."""
+
+    def __init__(self, channels, size):
+        self.channels = set(channels)
+        self.events = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, channel, data):
+        try:
+            self.events.put_nowait((channel, data))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """The next (channel, data) event, RESET if events were lost since
+        the last one, or None if there are none within `timeout` seconds."""
+
+        if self.overflowed:
+            self.overflowed = False
+            while not self.events.empty():
+                self.events.get_nowait()
+            return RESET
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    """This process's subscriptions, by channel."""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, max_streams=DEFAULT_MAX_STREAMS):
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.subscriptions = set()
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        """A new Subscription to `channels`, or None if the hub is full."""
+
+        with self.lock:
+            if len(self.subscriptions) >= self.max_streams:
+                return None
+
+            subscription = Subscription(channels, self.queue_size)
+            self.subscriptions.add(subscription)
+            for channel in subscription.channels:
+                self.channels.setdefault(channel, set()).add(subscription)
+            return subscription
+
+    def listen(self, subscription, channel, listening=True):
+        """Add `channel` to `subscription`, or with `listening` false, remove it."""
+
+        with self.lock:
+            if subscription not in self.subscriptions:
+                return
+
+            if listening:
+                subscription.channels.add(channel)
+                self.channels.setdefault(channel, set()).add(subscription)
+            else:
+                subscription.channels.discard(channel)
+                self._remove(channel, subscription)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            for channel in subscription.channels:
+                self._remove(channel, subscription)
+
+    def deliver(self, channel, data):
+        with self.lock:
+            for subscription in self.channels.get(channel, ()):
+                subscription.put(channel, data)
+
+    def reset(self):
+        """Tell every subscription it may have missed events."""
+
+        with self.lock:
+            for subscription in self.subscriptions:
+                subscription.overflowed = True
+
+    def _remove(self, channel, subscription):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.channels[channel]
+
+
+class LocalBackend:
+    """Delivers events to this process's subscriptions."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, channel, data):
+        self.hub.deliver(channel, data)
+
+    def close(self):
+        pass
+
+
+class SocketBackend:
+    """Sends events through the broker on the unix socket at `path`, and
+    delivers what it relays (including this process's own events) to
+    this process's subscriptions."""
+
+    def __init__(self, hub, path):
+        self.hub = hub
+        self.path = path
+        self.sock = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.connected = threading.Event()
+        threading.Thread(target=self._receive, name='live-receiver',
+                         daemon=True).start()
+
+    def publish(self, channel, data):
+        line = json.dumps([channel, data]).encode('utf-8') + b'\n'
+        with self.lock:
+            if self.sock is None:
+                logger.warning("No live broker at %s; dropped an event", self.path)
+                return
+            try:
+                self.sock.sendall(line)
+            except OSError:
+                logger.warning("Lost the live broker at %s; dropped an event", self.path)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            if self.sock is not None:
+                self.sock.shutdown(socket.SHUT_RDWR)
+
+    def _receive(self):
+        delay = 0.1
+        while not self.closed:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+
+            delay = 0.1
+            try:
+                lines = sock.makefile('rb')
+                # the broker sends a blank line once it relays to us
+                if lines.readline() == b'\n':
+                    with self.lock:
+                        self.sock = sock
+                    self.connected.set()
+
+                    for line in lines:
+                        channel, data = json.loads(line)
+                        self.hub.deliver(channel, data)
+            except (OSError, ValueError):
+                pass
+            finally:
+                with self.lock:
+                    self.sock = None
+                self.connected.clear()
+                sock.close()
+
+            # whatever was sent while we were disconnected is gone
+            self.hub.reset()
+
+
+def init_app(app):
+    """Publish `app`'s live timeline events with its LIVE_BACKEND."""
+
+    app.config.setdefault('LIVE_BACKEND', 'local')
+    app.config.setdefault('LIVE_SOCKET', DEFAULT_SOCKET)
+    app.config.setdefault('LIVE_HEARTBEAT', DEFAULT_HEARTBEAT)
+    app.config.setdefault('LIVE_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+    app.config.setdefault('LIVE_MAX_STREAMS', DEFAULT_MAX_STREAMS)
+
+    if app.config['LIVE_BACKEND'] not in BACKENDS:
+        raise ValueError(f"LIVE_BACKEND must be one of {BACKENDS}, "
+                         f"not {app.config['LIVE_BACKEND']!r}")
+
+    app.extensions['live'] = {'backend': None, 'lock': threading.Lock()}
+
+
+def backend():
+    """The app's backend, started on first use (so in each worker process,
+    not in a prefork server's master)."""
+
+    state = current_app.extensions['live']
+    with state['lock']:
+        if state['backend'] is None:
+            config = current_app.config
+            hub = Hub(config['LIVE_QUEUE_SIZE'], config['LIVE_MAX_STREAMS'])
+            if config['LIVE_BACKEND'] == 'socket':
+                state['backend'] = SocketBackend(hub, config['LIVE_SOCKET'])
+            else:
+                state['backend'] = LocalBackend(hub)
+
+        return state['backend']
+
+
+def messages_channel(user_id):
+    return f"messages:{user_id}"
+
+
+def follows_channel(user_id):
+    return f"follows:{user_id}"
+
+
+def announce_message(message_id, author_id):
+    """Tell the author's followers' streams about a new message."""
+
+    backend().publish(messages_channel(author_id),
+                      {'id': message_id, 'user_id': author_id})
+
+
+def announce_follow(user_id, followed_id, following=True):
+    """Tell `user_id`'s streams they now follow `followed_id` (or, with
+    `following` false, don't any more)."""
+
+    backend().publish(follows_channel(user_id),
+                      {'user_id': followed_id, 'following': following})
+
+
+def subscribe(user_id, followed_ids):
+    """A Subscription for `user_id`'s home timeline, or None if this
+    process has as many streams as it may."""
+
+    channels = [messages_channel(user_id), follows_channel(user_id)]
+    channels += [messages_channel(followed_id) for followed_id in followed_ids]
+    return backend().hub.subscribe(channels)
+
+
+def event_stream(subscription):
+    """A response streaming `subscription`'s events, which unsubscribes it
+    when done."""
+
+    hub = backend().hub
+    heartbeat = current_app.config['LIVE_HEARTBEAT']
+
+    def events():
+        yield f"retry: {RETRY_MS}\n\n"
+        while True:
+            event = subscription.get(heartbeat)
+            if event is None:
+                yield ": heartbeat\n\n"
+            elif event is RESET:
+                yield "event: reset\ndata: {}\n\n"
+            else:
+                channel, data = event
+                if channel.startswith('follows:'):
+                    hub.listen(subscription, messages_channel(data['user_id']),
+                               data['following'])
+                else:
+                    yield f"id: {data['id']}\ndata: {json.dumps(data)}\n\n"
+
+    response = current_app.response_class(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # so nginx passes events on as they come
+    response.headers['X-Accel-Buffering'] = 'no'
+    # run when the server is done with the response, even if it never started
+    response.call_on_close(lambda: hub.unsubscribe(subscription))
+    return response
+
+
+def run_broker(path=DEFAULT_SOCKET, max_buffer=BROKER_BUFFER):
+    """Relay every line any client sends on the unix socket at `path` to
+    every client, until interrupted."""
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    asyncio.run(_serve(path, max_buffer))
+
+
+async def _serve(path, max_buffer):
+    clients = set()
+
+    async def relay(reader, writer):
+        clients.add(writer)
+        writer.write(b'\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for client in list(clients):
+                    if client.transport.get_write_buffer_size() > max_buffer:
+                        # a worker that can't keep up; it reconnects and resets
+                        clients.discard(client)
+                        client.close()
+                    else:
+                        client.write(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(relay, path)
+    logger.info("Live broker listening on %s", path)
+    async with server:
+        await server.serve_forever()
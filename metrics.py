@@ -0,0 +1,261 @@
+"""Request metrics, served at /metrics in Prometheus text format.
+
+Every request is timed from its first before_request hook until its
+response has been sent (the end of the stream, for streamed ones), and
+counted by endpoint and status. Alongside, each endpoint adds up the time
+its requests spent in SQL (and how many statements they ran), rendering
+templates and in bcrypt, so dividing by the request count gives the
+per-request cost of each.
+
+The counters are per process, and per thread within it: each thread only
+ever writes to its own shard, so recording takes no locks, and /metrics
+adds the shards up when scraped. Scrape every worker process to see them
+all. /metrics is only served to METRICS_ALLOWED_ADDRESSES (by default
+just the machine itself).
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import (current_app, g, has_request_context, request, abort,
+                   before_render_template, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import instrumentation
+import passwords
+import pools
+
+# upper bounds, in seconds, of the request latency histogram's buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LOCAL_ADDRESSES = pools.LOCAL_ADDRESSES
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# per-endpoint totals: (name, help)
+TOTALS = (
+    ('sql_statements_total', 'SQL statements run by requests.'),
+    ('sql_seconds_total', 'Time requests spent running SQL statements.'),
+    ('template_seconds_total', 'Time requests spent rendering templates.'),
+    ('bcrypt_seconds_total', 'Time requests spent hashing and checking passwords.'),
+)
+
+
+class Shard:
+    """One thread's counters.
+
+    `latency` maps an endpoint to its histogram: a count per bucket (the
+    last one past the largest bound) followed by the sum of latencies.
+    `counts` maps (total name, endpoint) or ('requests_total', endpoint,
+    status) to a number.
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.counts = {}
+
+    def add(self, key, amount):
+        self.counts[key] = self.counts.get(key, 0) + amount
+
+    def observe(self, endpoint, seconds):
+        histogram = self.latency.get(endpoint)
+        if histogram is None:
+            histogram = self.latency[endpoint] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+
+_shards = []
+_register_lock = threading.Lock()
+_local = threading.local()
+
+
+def init_app(app):
+    """Record metrics for `app`'s requests and serve them at /metrics.
+
+    Call this before registering other before_request hooks, so their
+    time is counted too.
+    """
+
+    app.config.setdefault('METRICS_ALLOWED_ADDRESSES', LOCAL_ADDRESSES)
+    app.before_request(start_request)
+    app.after_request(note_status)
+    app.teardown_request(finish_request)
+    before_render_template.connect(_start_template, app)
+    template_rendered.connect(_finish_template, app)
+    passwords.bcrypt_finished.connect(_count_bcrypt)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
+
+
+def shard():
+    """This thread's counters, made on first use."""
+
+    current = getattr(_local, 'shard', None)
+    if current is None:
+        current = _local.shard = Shard()
+        with _register_lock:
+            _shards.append(current)
+    return current
+
+
+def snapshot():
+    """This process's counters, added up across threads, as (latency,
+    counts) in the form Shard keeps them."""
+
+    with _register_lock:
+        shards = list(_shards)
+
+    latency, counts = {}, {}
+    for each in shards:
+        # copying a dict or list is atomic, so this never sees one mid-update
+        for endpoint, histogram in each.latency.copy().items():
+            total = latency.setdefault(endpoint, [0] * len(histogram))
+            for i, value in enumerate(list(histogram)):
+                total[i] += value
+        for key, value in each.counts.copy().items():
+            counts[key] = counts.get(key, 0) + value
+
+    return latency, counts
+
+
+def reset():
+    """Forget every count, in every thread."""
+
+    with _register_lock:
+        for each in _shards:
+            each.latency = {}
+            each.counts = {}
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_sql_seconds = g.metrics_template_seconds = 0.0
+    g.metrics_bcrypt_seconds = 0.0
+    g.metrics_templates = []
+
+
+def note_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def finish_request(exc):
+    start = g.get('metrics_start')
+    if start is None:
+        return
+
+    endpoint = request.endpoint or 'unmatched'
+    status = 500 if exc is not None else g.get('metrics_status', 500)
+
+    counters = shard()
+    counters.observe(endpoint, time.perf_counter() - start)
+    counters.add(('requests_total', endpoint, str(status)), 1)
+    counters.add(('sql_statements_total', endpoint),
+                 instrumentation.statement_count())
+    counters.add(('sql_seconds_total', endpoint), g.metrics_sql_seconds)
+    counters.add(('template_seconds_total', endpoint), g.metrics_template_seconds)
+    counters.add(('bcrypt_seconds_total', endpoint), g.metrics_bcrypt_seconds)
+
+
+def serve_metrics():
+    """This process's metrics, in Prometheus text format."""
+
+    if request.remote_addr not in current_app.config['METRICS_ALLOWED_ADDRESSES']:
+        abort(404)
+
+    db = current_app.extensions['sqlalchemy'].db
+    pool = pools.engine_stats(db.engine)
+    return current_app.response_class(
+        render(*snapshot(), pool=pool), content_type=CONTENT_TYPE)
+
+
+def render(latency, counts, pool=None):
+    """`latency` and `counts` (as from snapshot()), and the primary's
+    pool statistics, as Prometheus exposition text."""
+
+    lines = [
+        '# HELP warbler_request_duration_seconds Time to serve a request.',
+        '# TYPE warbler_request_duration_seconds histogram',
+    ]
+    for endpoint, histogram in sorted(latency.items()):
+        label = f'endpoint="{_escape(endpoint)}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+            cumulative += count
+            lines.append(f'warbler_request_duration_seconds_bucket'
+                         f'{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'warbler_request_duration_seconds_sum{{{label}}} '
+                     f'{histogram[-1]!r}')
+        lines.append(f'warbler_request_duration_seconds_count{{{label}}} '
+                     f'{cumulative}')
+
+    lines += [
+        '# HELP warbler_requests_total Requests served.',
+        '# TYPE warbler_requests_total counter',
+    ]
+    for key, value in sorted(counts.items()):
+        if key[0] == 'requests_total':
+            lines.append(f'warbler_requests_total{{endpoint="{_escape(key[1])}",'
+                         f'status="{key[2]}"}} {value}')
+
+    for name, help in TOTALS:
+        lines += [f'# HELP warbler_{name} {help}',
+                  f'# TYPE warbler_{name} counter']
+        for key, value in sorted(counts.items()):
+            if key[0] == name:
+                lines.append(f'warbler_{name}{{endpoint="{_escape(key[1])}"}} '
+                             f'{value!r}')
+
+    if pool and 'checkouts' in pool:
+        for name, kind, value in (
+                ('db_pool_checked_out', 'gauge', pool['checked_out']),
+                ('db_pool_overflow', 'gauge', pool['overflow']),
+                ('db_pool_checkouts_total', 'counter', pool['checkouts']),
+                ('db_pool_checkout_wait_seconds_total', 'counter',
+                 pool['checkout_wait_ms'] / 1000),
+                ('db_pool_timeouts_total', 'counter', pool['timeouts'])):
+            lines += [f'# TYPE warbler_{name} {kind}',
+                      f'warbler_{name} {value!r}']
+
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _start_template(sender, template, context, **extra):
+    if 'metrics_templates' in g:
+        g.metrics_templates.append(time.perf_counter())
+
+
+def _finish_template(sender, template, context, **extra):
+    started = g.get('metrics_templates')
+    if started:
+        start = started.pop()
+        # only the outermost render, so included templates aren't counted twice
+        if not started:
+            g.metrics_template_seconds += time.perf_counter() - start
+
+
+def _count_bcrypt(sender, seconds):
+    if has_request_context() and 'metrics_bcrypt_seconds' in g:
+        g.metrics_bcrypt_seconds += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is not None and has_request_context():
+        context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_statement(conn, cursor, statement, parameters, context,
+                      executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is not None and 'metrics_sql_seconds' in g:
+        g.metrics_sql_seconds += time.perf_counter() - start
@@ -2,11 +2,13 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,39 +28,265 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+
+TOGGLE_LIKE = db.text("""
+    WITH deleted AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING 1
+    ), inserted AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT FROM deleted)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), counted AS (
+        UPDATE users
+        SET likes_count = likes_count
+            + (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted)
+        WHERE id = :user_id
+    )
+    SELECT NOT EXISTS (SELECT FROM deleted)
+""")
+
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
 
-    __tablename__ = 'likes' 
+    Keyed on (user_id, message_id), so a user likes a message at most once
+    and any number of users can like it; `ix_likes_message_id` serves
+    lookups of a message's likers.
+    """
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     @classmethod
-    def unlike(cls, message_id):
-        """Method for removing a like from the users list"""
-        like = Likes.query.filter(Likes.message_id == message_id).first()
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id` if they don't, unlike it if they
+        do, and update their likes count. Returns whether it is now liked.
+
+        On PostgreSQL this is one statement: a DELETE, an INSERT that only
+        runs if nothing was deleted, and the counter UPDATE, as CTEs. If a
+        concurrent toggle inserts first, ON CONFLICT leaves its like (and
+        count) be, so the message ends up liked once and counted once.
+        Raises IntegrityError if the message doesn't exist. Doesn't commit.
+        """
+
+        params = dict(user_id=user_id, message_id=message_id)
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            return db.session.execute(TOGGLE_LIKE, params).scalar()
+
+        deleted = (db.session
+                   .execute(cls.__table__
+                            .delete()
+                            .where(cls.user_id == user_id)
+                            .where(cls.message_id == message_id))
+                   .rowcount)
+        if not deleted:
+            db.session.execute(cls.__table__.insert(), params)
+        User.adjust_counts(user_id, likes=-1 if deleted else 1)
+        return not deleted
+
+    @classmethod
+    def set_likes(cls, user_id, wanted):
+        """Make `user_id` like (True) or not like (False) each message in
+        `wanted`, a dict of message id to state, and update their count.
+
+        Set-based: one query for which of the messages exist and are liked,
+        one multi-row INSERT and one DELETE, whatever the number of
+        messages. Likes a concurrent request added first are skipped (ON
+        CONFLICT DO NOTHING, on PostgreSQL), and the count only moves by the
+        rows actually inserted and deleted. Returns the resulting state of
+        every message that exists. Doesn't commit.
+        """
+
+        if not wanted:
+            return {}
+
+        rows = (db.session
+                .query(Message.id, cls.user_id)
+                .outerjoin(cls, db.and_(cls.message_id == Message.id,
+                                        cls.user_id == user_id))
+                .filter(Message.id.in_(list(wanted)))
+                .all())
+        liked = {message_id for message_id, liker_id in rows
+                 if liker_id is not None}
+        states = {message_id: wanted[message_id] for message_id, _ in rows}
+
+        to_like = [message_id for message_id, state in states.items()
+                   if state and message_id not in liked]
+        to_unlike = [message_id for message_id, state in states.items()
+                     if not state and message_id in liked]
+
+        inserted = deleted = 0
+        if to_like:
+            values = [dict(user_id=user_id, message_id=message_id)
+                      for message_id in to_like]
+            if db.session.get_bind().dialect.name == 'postgresql':
+                insert = (postgresql.insert(cls.__table__)
+                          .values(values)
+                          .on_conflict_do_nothing()
+                          .returning(cls.message_id))
+                inserted = len(db.session.execute(insert).fetchall())
+            else:
+                db.session.execute(cls.__table__.insert(), values)
+                inserted = len(values)
+        if to_unlike:
+            deleted = (db.session
+                       .execute(cls.__table__
+                                .delete()
+                                .where(cls.user_id == user_id)
+                                .where(cls.message_id.in_(to_unlike)))
+                       .rowcount)
+        if inserted or deleted:
+            User.adjust_counts(user_id, likes=inserted - deleted)
+
+        return states
+
+
+
+class FollowState:
+    """Sets of the users a viewer follows and is followed by.
+
+    Only users passed to `load` (or asked about) are looked up, in one
+    query per call, so checking a page of N users costs one query and N
+    set lookups instead of scanning the viewer's whole follow lists.
+    Directions already known in full (`following`/`followers` given) are
+    answered without any query.
+    """
+
+    def __init__(self, user_id, following=None, followers=None):
+        self.user_id = user_id
+        self.known = set()
+        self.all_following = following is not None
+        self.all_followers = followers is not None
+        self.following = set(following or ())
+        self.followers = set(followers or ())
+
+    def load(self, user_ids):
+        """Look up the follow state between the viewer and `user_ids`."""
+
+        user_ids = set(user_ids) - self.known
+        if not user_ids:
+            return
+
+        criteria = []
+        if not self.all_following:
+            criteria.append(
+                db.and_(Follows.user_following_id == self.user_id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        if not self.all_followers:
+            criteria.append(
+                db.and_(Follows.user_being_followed_id == self.user_id,
+                        Follows.user_following_id.in_(user_ids)))
+
+        if criteria:
+            rows = (db.session
+                    .query(Follows.user_being_followed_id,
+                           Follows.user_following_id)
+                    .filter(db.or_(*criteria))
+                    .all())
+
+            for followed_id, follower_id in rows:
+                if follower_id == self.user_id and not self.all_following:
+                    self.following.add(followed_id)
+                if followed_id == self.user_id and not self.all_followers:
+                    self.followers.add(follower_id)
+
+        self.known |= user_ids
+
+    def is_following(self, user_id):
+        """Does the viewer follow `user_id`?"""
+
+        if not self.all_following:
+            self.load([user_id])
+        return user_id in self.following
+
+    def is_followed_by(self, user_id):
+        """Is the viewer followed by `user_id`?"""
+
+        if not self.all_followers:
+            self.load([user_id])
+        return user_id in self.followers
+
+
+class ViewerMixin:
+    """Follow and like lookups for a user viewing pages.
+
+    Shared by `User` and the lightweight `g.user` records of
+    current_user.py; needs only an `id` attribute.
+    """
+
+    @property
+    def follow_state(self):
+        """Who this user follows / is followed by, among users asked about.
+
+        Kept on the instance, so it lasts as long as the instance does:
+        one request in the app. Views listing users call
+        `follow_state.load(...)` with the whole page first.
+        """
+
+        state = self.__dict__.get('_follow_state')
+        if state is None:
+            state = self.__dict__['_follow_state'] = self.new_follow_state()
+        return state
+
+    def new_follow_state(self):
+        return FollowState(self.id)
+
+    def forget_follow_state(self):
+        """Drop the cached follow state, e.g. after following someone."""
+
+        self.__dict__.pop('_follow_state', None)
+
+    def liked_message_ids(self, messages):
+        """IDs of the `messages` this user has liked, in one query."""
+
+        message_ids = [msg.id for msg in messages]
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids))
+                .all())
+        return {message_id for (message_id,) in rows}
 
-        db.session.delete(like)
-        db.session.commit()
- 
+    def is_followed_by(self, other_user):
+        """Is this user followed by `other_user`?"""
+
+        return self.follow_state.is_followed_by(other_user.id)
 
+    def is_following(self, other_user):
+        """Is this user following `other_use`?"""
 
-class User(db.Model):
+        return self.follow_state.is_following(other_user.id)
+
+
+class User(ViewerMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -103,7 +331,72 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts for profile headers, kept up to date by the views
+    # that write messages, follows and likes (see `adjust_counts`), and
+    # rebuilt by `reconcile_counts`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set while this user has too many followers to fan out to; their
+    # messages are then pulled into followers' timelines at read time.
+    # Maintained by timeline.py.
+    fanout_pulled = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Bumped whenever the set of users this user follows changes, so
+    # clients can tell their cached home timeline is stale (see
+    # timeline.timeline_version).
+    follows_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        # the few pulled authors (see timeline.pulled_authors); partial on
+        # PostgreSQL, so it only holds them
+        db.Index('ix_users_fanout_pulled', 'fanout_pulled',
+                 postgresql_where=db.text('fanout_pulled')),
+    )
+
+    # passive_deletes lets ON DELETE CASCADE remove a deleted user's
+    # messages, instead of the ORM trying to null out their user_id
+    messages = db.relationship(
+        'Message',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
@@ -127,17 +420,104 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
-    def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+    def new_follow_state(self):
+        """A FollowState, filled in from follow collections already loaded."""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        following = followers = None
+        if 'following' in self.__dict__:
+            following = {user.id for user in self.following}
+        if 'followers' in self.__dict__:
+            followers = {user.id for user in self.followers}
 
-    def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        return FollowState(self.id, following, followers)
+
+    @classmethod
+    def adjust_counts(cls, user_id, follows_changed=False, **deltas):
+        """Add `deltas` to a user's counters, e.g. `adjust_counts(1, likes=-1)`,
+        and bump their `follows_version` if `follows_changed`.
+
+        Done as a single UPDATE so concurrent writers don't lose counts.
+        """
+
+        values = {}
+        if follows_changed:
+            values[cls.follows_version] = cls.follows_version + 1
+        for name, delta in deltas.items():
+            column = getattr(cls, f"{name}_count")
+            values[column] = column + delta
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        (cls
+         .query
+         .filter(cls.id == user_id)
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def release_counts(cls, user_id):
+        """Take a user who is about to be deleted out of everyone else's counts.
+
+        Their follows, and the likes on their messages, go away with them
+        through ON DELETE CASCADE, which doesn't touch the counters.
+        """
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id,
+                            Follows.user_being_followed_id != user_id))
+        (cls
+         .query
+         .filter(cls.id.in_(followed.subquery()))
+         .update({cls.followers_count: cls.followers_count - 1},
+                 synchronize_session=False))
+
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id,
+                             Follows.user_following_id != user_id))
+        (cls
+         .query
+         .filter(cls.id.in_(followers.subquery()))
+         .update({cls.following_count: cls.following_count - 1,
+                  cls.follows_version: cls.follows_version + 1},
+                 synchronize_session=False))
+
+        liked = (db.session
+                 .query(db.func.count())
+                 .select_from(Likes)
+                 .join(Message, Message.id == Likes.message_id)
+                 .filter(Likes.user_id == cls.id,
+                         Message.user_id == user_id)
+                 .as_scalar())
+        likers = (db.session
+                  .query(Likes.user_id)
+                  .join(Message, Message.id == Likes.message_id)
+                  .filter(Message.user_id == user_id,
+                          Likes.user_id != user_id))
+        (cls
+         .query
+         .filter(cls.id.in_(likers.subquery()))
+         .update({cls.likes_count: cls.likes_count - liked},
+                 synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        def count(*criteria):
+            return (db.session
+                    .query(db.func.count())
+                    .filter(*criteria)
+                    .as_scalar())
+
+        (cls
+         .query
+         .update({
+             cls.messages_count: count(Message.user_id == cls.id),
+             cls.following_count: count(Follows.user_following_id == cls.id,
+                                        Follows.user_being_followed_id != cls.id),
+             cls.followers_count: count(Follows.user_being_followed_id == cls.id,
+                                        Follows.user_following_id != cls.id),
+             cls.likes_count: count(Likes.user_id == cls.id),
+         }, synchronize_session=False))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -146,7 +526,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -167,13 +547,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed with an out-of-date work factor is rehashed;
+        the caller commits it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
@@ -197,7 +582,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -208,6 +593,112 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    @classmethod
+    def release_counts(cls, message):
+        """Take a message that is about to be deleted out of the user counts."""
+
+        User.adjust_counts(message.user_id, messages=-1)
+
+        likers = (db.session
+                  .query(Likes.user_id)
+                  .filter(Likes.message_id == message.id))
+        (User
+         .query
+         .filter(User.id.in_(likers.subquery()))
+         .update({User.likes_count: User.likes_count - 1},
+                 synchronize_session=False))
+
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp',
+                 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    `author_id` and `timestamp` are copied from the message so a timeline
+    can be read, and trimmed on unfollow, without touching `messages`.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # unfollows (timeline.remove_follow), and ON DELETE CASCADE when an
+        # author is deleted
+        db.Index('ix_timelines_author_id', 'author_id', 'user_id'),
+        # ON DELETE CASCADE when a message is deleted
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+
+class MessageTerm(db.Model):
+    """A word in a message: the posting lists of message search.
+
+    Only used on databases without built-in full-text search (see
+    search.py); on PostgreSQL this table stays empty.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.String(64),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # times the term appears in the message
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # unindexing (search.unindex_message), and ON DELETE CASCADE
+        db.Index('ix_message_terms_message_id', 'message_id'),
+    )
+
+
+@event.listens_for(User.following, 'append')
+@event.listens_for(User.following, 'remove')
+@event.listens_for(User.followers, 'append')
+@event.listens_for(User.followers, 'remove')
+def _follows_changed(user, other_user, initiator):
+    """Follows changed in Python: cached follow state is out of date."""
+
+    user.forget_follow_state()
+    other_user.forget_follow_state()
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,70 @@
+"""Keyset ("cursor") pagination for message lists.
+
+Pages are ordered newest first on (timestamp, id). A cursor is the
+"<timestamp>,<id>" of the last message on a page, and the next page is
+everything strictly before it, so each page is one index range read no
+matter how far back it is.
+"""
+
+from datetime import datetime
+
+from flask import request, abort
+from sqlalchemy import tuple_
+
+PAGE_SIZE = 50
+MAX_ID = 2 ** 31 - 1
+
+
+def make_cursor(msg):
+    """Cursor for the page that follows `msg`."""
+
+    return f"{msg.timestamp.isoformat()},{msg.id}"
+
+
+def parse_cursor(value):
+    """Parse a cursor made by `make_cursor` into (timestamp, id).
+
+    Raises ValueError if `value` is not a valid cursor.
+    """
+
+    timestamp, _, msg_id = value.rpartition(",")
+    msg_id = int(msg_id)
+
+    # ids are 32-bit integer columns; anything larger can't be a real id
+    # and would fail in the database instead of here
+    if not 0 <= msg_id <= MAX_ID:
+        raise ValueError(f"cursor id out of range: {msg_id}")
+
+    return datetime.fromisoformat(timestamp), msg_id
+
+
+def cursor_from_request():
+    """The `before` cursor of the current request, or None on the first page."""
+
+    value = request.args.get('before')
+    if not value:
+        return None
+
+    try:
+        return parse_cursor(value)
+    except ValueError:
+        abort(400)
+
+
+def before(query, timestamp_col, id_col, cursor):
+    """Restrict `query` to rows ordered before `cursor`, if there is one."""
+
+    if cursor is None:
+        return query
+
+    return query.filter(tuple_(timestamp_col, id_col) < tuple_(*cursor))
+
+
+def split_page(messages, size=PAGE_SIZE):
+    """Split `size + 1` fetched messages into (page, next cursor or None)."""
+
+    if len(messages) <= size:
+        return messages, None
+
+    page = messages[:size]
+    return page, make_cursor(page[-1])
@@ -0,0 +1,161 @@
+"""Password hashing and checking, off the request thread.
+
+bcrypt is slow on purpose, so hashing and checking run in a small process
+pool (PASSWORD_HASH_WORKERS processes; 0 runs them inline). At most
+PASSWORD_HASH_QUEUE jobs wait for the pool at once; further callers block
+until there is room, so a login burst queues up here instead of piling
+work onto the pool.
+
+BCRYPT_LOG_ROUNDS is the work factor for new hashes. Hashes made with a
+different work factor still check, and `needs_rehash` tells callers to
+replace them (see `User.authenticate`), so the cost can be changed
+without downtime.
+
+Every hash or check sends `bcrypt_finished` with the seconds it took
+(queueing included), which metrics.py adds up per request.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+from flask.signals import Namespace
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+
+_state = {'app': None, 'executor': None, 'workers': None, 'slots': None}
+_lock = threading.Lock()
+
+bcrypt_finished = Namespace().signal('bcrypt-finished')
+
+
+def init_app(app):
+    """Hash and check passwords with `app`'s settings."""
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', DEFAULT_WORKERS)
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 64)
+    _state['app'] = app
+
+
+def hash_password(password):
+    """A bcrypt hash of `password`, as text.
+
+    Raises ValueError if `password` is empty.
+    """
+
+    password = _encode(password)
+    return _run(_hash, password, _config('BCRYPT_LOG_ROUNDS'))
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    if not password or not hashed:
+        return False
+
+    return _run(_check, hashed.encode('utf-8'), _encode(password))
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a work factor other than BCRYPT_LOG_ROUNDS?"""
+
+    # bcrypt hashes look like "$2b$12$<salt and hash>"
+    try:
+        rounds = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+
+    return rounds != _config('BCRYPT_LOG_ROUNDS')
+
+
+def shutdown():
+    """Stop this process's hashing workers, if it has any."""
+
+    with _lock:
+        executor = _state['executor']
+        _state['executor'] = _state['workers'] = None
+
+    if executor is not None:
+        executor.shutdown()
+
+
+def _config(key):
+    app = current_app._get_current_object() if has_app_context() else _state['app']
+    if app is None:
+        return {'BCRYPT_LOG_ROUNDS': DEFAULT_ROUNDS,
+                'PASSWORD_HASH_WORKERS': 0,
+                'PASSWORD_HASH_QUEUE': 1}[key]
+
+    return app.config[key]
+
+
+def _encode(password):
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return password
+
+
+def _run(fn, *args):
+    """Run `fn(*args)` in the pool, or inline when there are no workers."""
+
+    start = time.perf_counter()
+    try:
+        executor, slots = _executor()
+        if executor is None:
+            return fn(*args)
+
+        with slots:
+            return executor.submit(fn, *args).result()
+    finally:
+        bcrypt_finished.send(None, seconds=time.perf_counter() - start)
+
+
+def _executor():
+    """This process's pool and queue slots, started on first use.
+
+    Pools are per process, so app servers that fork workers after
+    importing the app get one each.
+    """
+
+    workers = _config('PASSWORD_HASH_WORKERS')
+    if not workers:
+        return None, None
+
+    with _lock:
+        if _state['executor'] is None or _state['workers'] != workers:
+            if _state['executor'] is not None:
+                _state['executor'].shutdown(wait=False)
+            _state['executor'] = ProcessPoolExecutor(max_workers=workers)
+            _state['workers'] = workers
+            _state['slots'] = threading.BoundedSemaphore(
+                _config('PASSWORD_HASH_QUEUE'))
+
+        return _state['executor'], _state['slots']
+
+
+def _forget_executor():
+    # a forked child can't use its parent's pool, so starts its own
+    _state['executor'] = _state['workers'] = _state['slots'] = None
+
+
+os.register_at_fork(after_in_child=_forget_executor)
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # not a bcrypt hash
+        return False
@@ -0,0 +1,201 @@
+"""Database connection pool settings and live pool statistics.
+
+Each process keeps DB_POOL_SIZE connections per engine (the primary and
+every replica), and may open DB_MAX_OVERFLOW more under load. Connections
+are replaced after DB_POOL_RECYCLE seconds, and with DB_POOL_PRE_PING
+they are checked before use, so ones the server dropped are never handed
+out. A request waits up to DB_POOL_TIMEOUT seconds for a connection.
+
+Pools are TimedQueuePools, which count how long checkouts wait and
+track connection churn. /internal/pool serves their numbers, with the
+pools' current size, checked-out and overflow counts, as JSON. It is
+only served to requests from the machine itself. Sizing pools per worker
+starts there: time spent waiting with no overflow left means the pool is
+too small, and steady churn means connections are being recycled or
+dropped.
+
+Connections are never shared across a fork: one checked out in a process
+other than the one that opened it is discarded and replaced, so a
+prefork server may fork workers from a master that used the database.
+"""
+
+import os
+import threading
+import time
+
+from flask import abort, current_app, jsonify, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_POOL_TIMEOUT = 30
+
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+
+
+class PoolCounters:
+    """Checkout waits and connection churn of a pool (and its recreations)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.closes = 0
+        self.invalidations = 0
+
+    def add(self, name, amount=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def waited(self, seconds):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records checkout waits and connection churn.
+
+    A pool recreated by engine.dispose() gets its predecessor's event
+    listeners, and so keeps counting into the same PoolCounters.
+    """
+
+    def __init__(self, *args, **kw):
+        recreated = '_dispatch' in kw
+        super().__init__(*args, **kw)
+        self.counters = PoolCounters()
+
+        if not recreated:
+            event.listen(self, 'connect', self._on_connect)
+            event.listen(self, 'checkout', self._on_checkout)
+            event.listen(self, 'close', self._on_close)
+            event.listen(self, 'invalidate', self._on_invalidate)
+            event.listen(self, 'soft_invalidate', self._on_invalidate)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.counters = self.counters
+        return pool
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        # what Engine.raw_connection() checks out with, before SQLAlchemy 1.4
+        return self._timed_checkout(super().unique_connection)
+
+    def _timed_checkout(self, checkout):
+        start = time.perf_counter()
+        try:
+            return checkout()
+        except exc.TimeoutError:
+            self.counters.add('timeouts')
+            raise
+        finally:
+            self.counters.waited(time.perf_counter() - start)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+        self.counters.add('connects')
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        if connection_record.info.get('pid') != os.getpid():
+            # the parent process's; using it would garble the parent's traffic
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection opened in another process")
+
+    def _on_close(self, dbapi_connection, connection_record):
+        self.counters.add('closes')
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.counters.add('invalidations')
+
+    def stats(self):
+        """The pool's counters, and its state right now."""
+
+        counters = self.counters
+        with counters.lock:
+            return {
+                'size': self.size(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'idle': self.checkedin(),
+                'checkouts': counters.checkouts,
+                'checkout_wait_ms': round(counters.wait_seconds * 1000, 3),
+                'max_checkout_wait_ms': round(counters.max_wait_seconds * 1000, 3),
+                'timeouts': counters.timeouts,
+                'connects': counters.connects,
+                'closes': counters.closes,
+                'invalidations': counters.invalidations,
+            }
+
+
+def init_app(app):
+    """Apply the pool settings to `app`'s engines and serve /internal/pool.
+
+    Call this before the app's engine is first used.
+    """
+
+    app.config.setdefault('DB_POOL_SIZE', DEFAULT_POOL_SIZE)
+    app.config.setdefault('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW)
+    app.config.setdefault('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)
+    app.config.setdefault('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)
+    app.config.setdefault('DB_POOL_PRE_PING', True)
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    for name, value in engine_options(
+            app, app.config['SQLALCHEMY_DATABASE_URI']).items():
+        options.setdefault(name, value)
+
+    app.add_url_rule('/internal/pool', 'pool_stats', pool_stats)
+
+
+def engine_options(app, url):
+    """create_engine() options for `url` under `app`'s pool settings.
+
+    SQLite keeps SQLAlchemy's own pooling, which suits it.
+    """
+
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {}
+
+    return dict(
+        poolclass=TimedQueuePool,
+        pool_size=app.config['DB_POOL_SIZE'],
+        max_overflow=app.config['DB_MAX_OVERFLOW'],
+        pool_recycle=app.config['DB_POOL_RECYCLE'],
+        pool_timeout=app.config['DB_POOL_TIMEOUT'],
+        pool_pre_ping=app.config['DB_POOL_PRE_PING'],
+    )
+
+
+def engine_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, TimedQueuePool):
+        return pool.stats()
+    return {'pool': type(pool).__name__}
+
+
+def pool_stats():
+    """Statistics of this process's pools, as JSON (local requests only)."""
+
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+
+    db = current_app.extensions['sqlalchemy'].db
+    replicas = current_app.extensions.get('replicas', {})
+
+    return jsonify(
+        primary=engine_stats(db.engine),
+        replicas={repr(engine.url): engine_stats(engine)
+                  for engine in replicas.values()},
+    )
@@ -0,0 +1,184 @@
+"""Profiling sampled requests, safely enough for production.
+
+Off by default. A request is profiled when a PROFILE_SAMPLE_RATE fraction
+of requests are chosen at random and it is one of them, or when it
+carries a PROFILE_HEADER token signed with the app's SECRET_KEY
+(`flask profile-token` prints one, good for PROFILE_TOKEN_MAX_AGE
+seconds), so a single slow page can be profiled on demand.
+
+With PROFILE_MODE 'sample' (the default), a background thread records
+the profiled request's stack every PROFILE_INTERVAL seconds. That costs
+the request almost nothing, and is written out as collapsed stacks
+("frame;frame;frame count" lines), which flamegraph.pl and speedscope
+read. With 'cprofile' the request runs under cProfile instead, which
+counts every call but slows the request down, and is written out as
+pstats.
+
+Each profiled request makes one file, under PROFILE_DIR/<endpoint>/, so
+the files for an endpoint can be combined: `cat profiles/homepage/*.collapsed
+| flamegraph.pl`, or `pstats.Stats(*glob('profiles/add_like/*.pstats'))`.
+"""
+
+import cProfile
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+MODES = ('sample', 'cprofile')
+
+DEFAULT_INTERVAL = 0.005
+
+TOKEN_SALT = 'warbler-profile'
+
+# this thread id -> the stacks sampled from it so far
+_sampled = {}
+_lock = threading.Lock()
+_sampler = {'thread': None}
+_serial = itertools.count()
+
+
+def init_app(app):
+    """Profile a sample of `app`'s requests."""
+
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILE_HEADER', 'X-Warbler-Profile')
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+    app.config.setdefault('PROFILE_MODE', 'sample')
+    app.config.setdefault('PROFILE_INTERVAL', DEFAULT_INTERVAL)
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.root_path, 'profiles'))
+
+    if app.config['PROFILE_MODE'] not in MODES:
+        raise ValueError(f"PROFILE_MODE must be one of {MODES}, "
+                         f"not {app.config['PROFILE_MODE']!r}")
+
+    app.before_request(start_profile)
+    app.teardown_request(finish_profile)
+
+
+def make_token(app):
+    """A PROFILE_HEADER value that has requests to `app` profiled."""
+
+    return _serializer(app).dumps('profile')
+
+
+def wanted():
+    """Should the current request be profiled?"""
+
+    config = current_app.config
+    token = request.headers.get(config['PROFILE_HEADER'])
+    if token:
+        try:
+            _serializer(current_app).loads(
+                token, max_age=config['PROFILE_TOKEN_MAX_AGE'])
+            return True
+        except BadSignature:
+            pass
+
+    rate = config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def start_profile():
+    g.profile = None
+    if not wanted():
+        return
+
+    if current_app.config['PROFILE_MODE'] == 'cprofile':
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running on this thread
+            return
+        g.profile = profile
+    else:
+        g.profile = Counter()
+        with _lock:
+            _sampled[threading.get_ident()] = g.profile
+        _start_sampler(current_app.config['PROFILE_INTERVAL'])
+
+
+def finish_profile(exc):
+    profile = g.get('profile')
+    if profile is None:
+        return
+
+    g.profile = None
+    if isinstance(profile, cProfile.Profile):
+        profile.disable()
+        path = _path('pstats')
+        profile.dump_stats(path)
+    else:
+        with _lock:
+            _sampled.pop(threading.get_ident(), None)
+        path = _path('collapsed')
+        with open(path, 'w') as f:
+            for stack, count in profile.most_common():
+                f.write(f"{stack} {count}\n")
+
+    current_app.logger.info("Profiled %s into %s", request.path, path)
+
+
+def collapse(frame):
+    """`frame`'s stack, outermost call first, as a collapsed-stack line."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                     f":{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=TOKEN_SALT)
+
+
+def _path(extension):
+    directory = os.path.join(current_app.config['PROFILE_DIR'],
+                             request.endpoint or 'unmatched')
+    os.makedirs(directory, exist_ok=True)
+    name = (f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+            f"-{next(_serial)}.{extension}")
+    return os.path.join(directory, name)
+
+
+def _start_sampler(interval):
+    with _lock:
+        if _sampler['thread'] is None or not _sampler['thread'].is_alive():
+            _sampler['thread'] = threading.Thread(
+                target=_sample, args=(interval,), name='profile-sampler',
+                daemon=True)
+            _sampler['thread'].start()
+
+
+def _sample(interval):
+    """Record the stacks of profiled requests' threads, until there are
+    none for a while."""
+
+    idle = 0
+    while True:
+        time.sleep(interval)
+        with _lock:
+            if not _sampled:
+                idle += 1
+                if idle * interval >= 1:
+                    # decided under the lock, so no request can be left unsampled
+                    _sampler['thread'] = None
+                    return
+                continue
+
+            idle = 0
+            frames = sys._current_frames()
+            for ident, stacks in _sampled.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[collapse(frame)] += 1
@@ -0,0 +1,110 @@
+"""Routing reads to database replicas.
+
+Views marked with `@replica_reads` run their queries on a replica (one of
+SQLALCHEMY_REPLICA_URLS, picked at random per request) when requested
+with GET. Every other request, and every flush, uses the primary
+(SQLALCHEMY_DATABASE_URI).
+
+Replicas lag the primary, so a client that has just written reads from
+the primary for REPLICA_STICKY_SECONDS afterwards. The time of its last
+write is kept in its session, which makes this work across processes.
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+
+import pools
+
+LAST_WRITE_KEY = 'last_write'
+
+DEFAULT_STICKY_SECONDS = 5
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                return replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession as its session."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_app(app):
+    """Route `app`'s replica-safe GET requests to its replicas, if any.
+
+    Call this before registering other before_request hooks, so their
+    queries are routed too.
+    """
+
+    app.config.setdefault('SQLALCHEMY_REPLICA_URLS', [])
+    app.config.setdefault('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+    app.extensions['replicas'] = {}
+    app.before_request(choose_replica)
+    app.after_request(remember_write)
+
+
+def replica_reads(view):
+    """Mark a view as only reading, so its GET requests can use a replica."""
+
+    view.replica_reads = True
+    return view
+
+
+def engines():
+    """Engines for the configured replica URLs, created on first use."""
+
+    cache = current_app.extensions['replicas']
+    urls = current_app.config['SQLALCHEMY_REPLICA_URLS']
+
+    for url in urls:
+        if url not in cache:
+            cache[url] = create_engine(
+                url, **pools.engine_options(current_app, url))
+
+    return [cache[url] for url in urls]
+
+
+def choose_replica():
+    g.db_replica = None
+
+    view = current_app.view_functions.get(request.endpoint)
+    if request.method != 'GET' or not getattr(view, 'replica_reads', False):
+        return
+
+    last_write = session.get(LAST_WRITE_KEY)
+    sticky = current_app.config['REPLICA_STICKY_SECONDS']
+    if last_write is not None and time.time() - last_write < sticky:
+        return
+
+    replicas = engines()
+    if replicas:
+        g.db_replica = random.choice(replicas)
+
+
+def remember_write(response):
+    if g.get('db_wrote'):
+        session[LAST_WRITE_KEY] = time.time()
+
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _note_write(conn, cursor, statement, parameters, context, executemany):
+    if (has_request_context()
+            and statement.lstrip()[:6].upper() != 'SELECT'):
+        g.db_wrote = True
@@ -0,0 +1,281 @@
+"""Search for users (/users?q=) and messages (/messages/search).
+
+A user search matches the usernames that start with its text, ignoring
+case.
+
+- PostgreSQL: an index on lower(username) in the "C" collation makes a
+  search one index range scan, read in rank order (the exact match, then
+  the rest alphabetically), so a page costs the same at any table size.
+- SQLite (local development): an FTS5 index of usernames, kept up to date
+  by triggers and ranked by bm25; it also matches words inside usernames,
+  e.g. "doe" finds "john_doe".
+- Anything else: a LIKE prefix match.
+
+A message search matches the messages containing all of its words.
+
+- PostgreSQL: a GIN index over to_tsvector(text), ranked by ts_rank.
+  The database keeps it up to date.
+- Anything else: posting lists in `message_terms`, one row per word per
+  message, written by `index_message` and removed by `unindex_message`
+  as messages are posted and deleted. Ranked by how often the words
+  appear.
+"""
+
+import re
+from collections import Counter
+
+from sqlalchemy import DDL, event, literal_column
+from sqlalchemy.sql import column, table
+from sqlalchemy.orm import joinedload, load_only
+
+from models import db, Message, MessageTerm, User
+from pagination import PAGE_SIZE
+
+USERS_PER_PAGE = 24
+
+TEXT_SEARCH_CONFIG = "'english'::regconfig"
+
+WORD = re.compile(r"\w+")
+
+# Columns shown on user cards
+CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url')
+
+# The SQLite FTS5 index (see INDEX_DDL)
+users_fts = table('users_fts', column('rowid'), column('rank'))
+
+
+##############################################################################
+# Users
+
+def search_users(text, page=1, per_page=USERS_PER_PAGE):
+    """Page `page` (from 1) of users matching `text`, best match first.
+
+    Returns (users, whether there is a next page).
+    """
+
+    users = (matching_users(db.session, text)
+             .options(load_only(*CARD_COLUMNS))
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+
+    return users[:per_page], len(users) > per_page
+
+
+def matching_users(session, text):
+    """Query for the users matching `text` in `session`, ranked."""
+
+    text = text.strip().lower()
+    dialect = _dialect(session)
+
+    if dialect == 'postgresql':
+        return _users_postgresql(session, text)
+    if dialect == 'sqlite':
+        return _users_sqlite(session, text)
+    return _users_like(session, text)
+
+
+def _users_postgresql(session, text):
+    key = db.func.lower(User.username).collate('C')
+
+    query = session.query(User).filter(key >= text)
+    if text:
+        # every string starting with `text` sorts before this one
+        query = query.filter(key < text[:-1] + chr(ord(text[-1]) + 1))
+
+    return query.order_by(key)
+
+
+def _users_sqlite(session, text):
+    if not text:
+        return _users_like(session, text)
+
+    phrase = '"' + text.replace('"', '""') + '"*'
+    return (session
+            .query(User)
+            .join(users_fts, users_fts.c.rowid == User.id)
+            .filter(literal_column('users_fts').op('MATCH')(phrase))
+            .order_by(users_fts.c.rank, db.func.length(User.username)))
+
+
+def _users_like(session, text):
+    key = db.func.lower(User.username)
+    pattern = (text.replace('\\', '\\\\')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+
+    return (session
+            .query(User)
+            .filter(key.like(pattern + '%', escape='\\'))
+            .order_by(key))
+
+
+##############################################################################
+# Messages
+
+def search_messages(text, page=1, per_page=PAGE_SIZE):
+    """Page `page` (from 1) of messages matching `text`, best match first.
+
+    Returns (messages, whether there is a next page).
+    """
+
+    messages = (matching_messages(db.session, text)
+                .options(joinedload(Message.user))
+                .offset((page - 1) * per_page)
+                .limit(per_page + 1)
+                .all())
+
+    return messages[:per_page], len(messages) > per_page
+
+
+def matching_messages(session, text):
+    """Query for the messages matching `text` in `session`, ranked."""
+
+    if not tokenize(text):
+        return session.query(Message).filter(db.false())
+
+    if _dialect(session) == 'postgresql':
+        return _messages_postgresql(session, text)
+    return _messages_posted(session, text)
+
+
+def tokenize(text):
+    """Count of each word in `text`, as stored in `message_terms`."""
+
+    max_length = MessageTerm.term.type.length
+    return Counter(word[:max_length] for word in WORD.findall(text.lower()))
+
+
+def index_message(session, msg):
+    """Add a newly-flushed `msg` to the message search index."""
+
+    if _dialect(session) == 'postgresql':
+        return
+
+    rows = [dict(term=term, message_id=msg.id, count=count)
+            for term, count in tokenize(msg.text).items()]
+    if rows:
+        session.execute(MessageTerm.__table__.insert(), rows)
+
+
+def unindex_message(session, msg):
+    """Take `msg` out of the message search index, before deleting it."""
+
+    if _dialect(session) == 'postgresql':
+        return
+
+    (session
+     .query(MessageTerm)
+     .filter(MessageTerm.message_id == msg.id)
+     .delete(synchronize_session=False))
+
+
+def reindex_messages(session):
+    """Rebuild the message search index from every message."""
+
+    if _dialect(session) == 'postgresql':
+        return
+
+    session.query(MessageTerm).delete(synchronize_session=False)
+    for msg in session.query(Message.id, Message.text).yield_per(1000):
+        index_message(session, msg)
+
+
+def _messages_postgresql(session, text):
+    vector = db.func.to_tsvector(literal_column(TEXT_SEARCH_CONFIG),
+                                 Message.text)
+    query = db.func.plainto_tsquery(literal_column(TEXT_SEARCH_CONFIG), text)
+
+    return (session
+            .query(Message)
+            .filter(vector.op('@@')(query))
+            .order_by(db.func.ts_rank(vector, query).desc(),
+                      Message.id.desc()))
+
+
+def _messages_posted(session, text):
+    terms = list(tokenize(text))
+    matches = (session
+               .query(MessageTerm.message_id,
+                      db.func.sum(MessageTerm.count).label('score'))
+               .filter(MessageTerm.term.in_(terms))
+               .group_by(MessageTerm.message_id)
+               .having(db.func.count() == len(terms))
+               .subquery())
+
+    return (session
+            .query(Message)
+            .join(matches, matches.c.message_id == Message.id)
+            .order_by(matches.c.score.desc(), Message.id.desc()))
+
+
+def _dialect(session):
+    return session.get_bind().dialect.name
+
+
+##############################################################################
+# Search indexes, created along with their tables, or for an existing
+# database by `create_search_index` (flask create-search-index)
+
+INDEX_DDL = {
+    (User.__table__, 'postgresql'): [
+        'CREATE INDEX IF NOT EXISTS ix_users_username_search '
+        'ON users ((lower(username) COLLATE "C"))',
+    ],
+    (Message.__table__, 'postgresql'): [
+        'CREATE INDEX IF NOT EXISTS ix_messages_text_search '
+        f'ON messages USING gin (to_tsvector({TEXT_SEARCH_CONFIG}, text))',
+    ],
+    (User.__table__, 'sqlite'): [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "username, content='users', content_rowid='id', prefix='1 2 3')",
+
+        "CREATE TRIGGER IF NOT EXISTS users_fts_insert "
+        "AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username); "
+        "END",
+
+        "CREATE TRIGGER IF NOT EXISTS users_fts_delete "
+        "AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts (users_fts, rowid, username) "
+        "VALUES ('delete', old.id, old.username); "
+        "END",
+
+        "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+        "AFTER UPDATE OF username ON users BEGIN "
+        "INSERT INTO users_fts (users_fts, rowid, username) "
+        "VALUES ('delete', old.id, old.username); "
+        "INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username); "
+        "END",
+
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+    ],
+}
+
+
+def create_search_index(session):
+    """Create the search indexes for `session`'s database, if missing."""
+
+    dialect = _dialect(session)
+    for (_, index_dialect), statements in INDEX_DDL.items():
+        if index_dialect == dialect:
+            for statement in statements:
+                session.execute(statement)
+
+
+def drop_search_index(session):
+    """Drop the PostgreSQL search indexes, e.g. for the length of a bulk
+    load (see seed.py); `create_search_index` puts them back."""
+
+    if _dialect(session) == 'postgresql':
+        for name in ('ix_users_username_search', 'ix_messages_text_search'):
+            session.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+for (_table, _index_dialect), _statements in INDEX_DDL.items():
+    for _statement in _statements:
+        event.listen(_table, 'after_create',
+                     DDL(_statement).execute_if(dialect=_index_dialect))
+
+event.listen(User.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS users_fts').execute_if(dialect='sqlite'))
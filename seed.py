@@ -1,20 +1,205 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
+    python seed.py                 # drop everything and load generator/*.csv
+    python seed.py --resume        # carry on after a failed load
+    python seed.py --chunk-size N  # rows per transaction (default 10000)
+
+CSV files are streamed in chunks, each loaded and committed in its own
+transaction: with COPY FROM STDIN on PostgreSQL, or executemany elsewhere.
+The `seed_progress` table records how many rows of each file are in, in
+the same transaction as the rows themselves, so --resume picks up at the
+first chunk that didn't make it.
+
+Secondary indexes are dropped for the load and built once at the end,
+along with the timelines and user counters that bulk loads skip.
+
+Each table may be split into shards (users-0000.csv, users-0001.csv, ...,
+as generator/create_csvs.py --shards writes them), loaded in name order.
+Users and messages take their ids from an `id` column, or failing that
+from their row number in their file, which is how follows.csv and
+messages.csv refer to them.
+"""
+
+import argparse
+import csv
+import io
+import sys
+import time
+from glob import glob
+from itertools import islice
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, inspect, text
+
+from app import app, db
 from models import User, Message, Follows
+import search
+from timeline import rebuild_timelines
+
+CHUNK_SIZE = 10000
+
+SOURCES = [
+    ('generator/users*.csv', User.__table__),
+    ('generator/messages*.csv', Message.__table__),
+    ('generator/follows*.csv', Follows.__table__),
+]
+
+progress = Table(
+    'seed_progress', MetaData(),
+    Column('source', Text, primary_key=True),
+    Column('rows', Integer, nullable=False),
+)
+
+
+def seed(resume=False, chunk_size=CHUNK_SIZE):
+    """Load every CSV matching SOURCES, then build indexes, timelines and counts."""
+
+    engine = db.engine
+
+    if not resume or not engine.has_table(progress.name):
+        db.drop_all()
+        db.create_all()
+        progress.drop(engine, checkfirst=True)
+        progress.create(engine)
+        drop_indexes()
+
+    for pattern, table in SOURCES:
+        for path in sorted(glob(pattern)):
+            load_csv(path, table, chunk_size)
+
+    finish()
+
+
+def drop_indexes():
+    """Drop the secondary indexes of the tables being loaded."""
+
+    for _, table in SOURCES:
+        for index in table.indexes:
+            index.drop(db.engine)
+
+    search.drop_search_index(db.session)
+    db.session.commit()
+
+
+def load_csv(path, table, chunk_size):
+    """Load the rows of `path` not yet loaded into `table`, a chunk at a time."""
+
+    loaded = (db.session
+              .query(progress.c.rows)
+              .filter(progress.c.source == path)
+              .scalar())
+    if loaded is None:
+        db.session.execute(progress.insert().values(source=path, rows=0))
+        db.session.commit()
+        loaded = 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+
+        # number rows from 1, as a SERIAL column would
+        numbered = 'id' in table.c and 'id' not in columns
+        if numbered:
+            columns = ['id'] + columns
+
+        rows = islice(reader, loaded, None)
+        if numbered:
+            rows = ([number] + row for number, row in enumerate(rows, loaded + 1))
+
+        start = time.monotonic()
+        count = 0
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            insert_rows(table, columns, chunk)
+            (db.session
+             .execute(progress.update()
+                      .where(progress.c.source == path)
+                      .values(rows=progress.c.rows + len(chunk))))
+            db.session.commit()
+
+            count += len(chunk)
+            report(path, loaded + count, count, start)
+
+    if not count:
+        print(f"{path}: already loaded ({loaded} rows)")
+
+
+def insert_rows(table, columns, rows):
+    """Insert `rows` (lists of CSV values for `columns`) into `table`."""
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv)",
+            buffer)
+    else:
+        # plain text, so values go to the database as they are in the CSV,
+        # as with COPY; empty values are NULL, as with COPY
+        insert = text(f"INSERT INTO {table.name} ({', '.join(columns)}) "
+                      f"VALUES ({', '.join(':' + column for column in columns)})")
+        db.session.execute(insert,
+                           [{column: value if value != '' else None
+                             for column, value in zip(columns, row)}
+                            for row in rows])
+
+
+def report(path, total, count, start):
+    elapsed = time.monotonic() - start
+    rate = count / elapsed if elapsed else float('inf')
+    print(f"{path}: {total} rows ({rate:,.0f} rows/sec)")
+
+
+def finish():
+    """Build what the load skipped. Safe to run again after a failure."""
+
+    start = time.monotonic()
+
+    for _, table in SOURCES:
+        existing = {index['name']
+                    for index in inspect(db.engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+    search.create_search_index(db.session)
 
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # ids were loaded explicitly, so move the sequences past them
+        for _, table in SOURCES:
+            if 'id' in table.c:
+                db.session.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"coalesce(max(id), 0) + 1, false) FROM {table.name}")
 
-db.drop_all()
-db.create_all()
+    # bulk loads skip fan-out and the user counters, so rebuild both in one pass
+    rebuild_timelines()
+    db.session.commit()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    print(f"indexes, timelines and counts built in "
+          f"{time.monotonic() - start:.1f}s")
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resume', action='store_true',
+                        help="continue a load that failed part way")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="rows per transaction")
+    args = parser.parse_args()
 
-db.session.commit()
+    with app.app_context():
+        try:
+            seed(resume=args.resume, chunk_size=args.chunk_size)
+        except Exception:
+            db.session.rollback()
+            print("Load failed; run again with --resume to continue.",
+                  file=sys.stderr)
+            raise
@@ -1,26 +1,63 @@
-const BASE_URL = "http://127.0.0.1:5000"
+// Clicks toggle the button at once and are queued; the queue is sent to
+// /api/likes as one batch once clicks stop for FLUSH_DELAY ms, so rapid
+// clicks on one or many messages cost a single request (only the last
+// click on each message counts). Buttons are then set to what the server
+// says, which undoes any click that didn't take.
 
+const FLUSH_DELAY = 300
 
-$('.like').click(async function(evt){
-    evt.preventDefault();
+let pending = {}
+let flushTimer = null
 
-    let msg_id = evt.target.id;
-    console.log(msg_id)
 
-    res = await axios.post(`${BASE_URL}/users/add_like/${msg_id}`);
+function showLiked(msg_id, liked) {
+    let $button = $(`#${msg_id}`)
+    $button.children().remove()
+    if (liked) {
+        $button.append('<i style="pointer-events: none" class="far fa-star fa-sm"></i>')
+        $button.removeClass('btn-secondary').addClass('btn-warning btn-sm')
+    } else {
+        $button.append('<i style="pointer-events: none" class="fa fa-thumbs-up"></i>')
+        $button.removeClass('btn-warning').addClass('btn-secondary')
+    }
+}
+
 
+async function flushLikes() {
+    flushTimer = null
+    let likes = Object.entries(pending).map(
+        ([message_id, liked]) => ({message_id: Number(message_id), liked}))
+    pending = {}
 
-    if (res.data == "liked") {
-        $(`#${msg_id}`).children().remove()
-        $(`#${msg_id}`).append('<i style="pointer-events: none" class="far fa-star fa-sm"<i>')
-        $(`#${msg_id}`).removeClass('btn-secondary').addClass('btn-warning btn-sm')
-    } else if (res.data === "unliked") {
-        $(`#${msg_id}`).children().remove()
-        $(`#${msg_id}`).append('<i style="pointer-events: none" class="fa fa-thumbs-up"<i>')
-        $(`#${msg_id}`).removeClass('btn-warning').addClass('btn-secondary')
+    try {
+        let res = await axios.post('/api/likes', {likes})
+        for (let {message_id, liked} of res.data.likes) {
+            // a newer click is queued; let it win
+            if (!(message_id in pending)) {
+                showLiked(message_id, liked)
+            }
+        }
+    } catch (err) {
+        for (let {message_id, liked} of likes) {
+            if (!(message_id in pending)) {
+                showLiked(message_id, !liked)
+            }
+        }
     }
-    return "done"
-    
+}
+
+
+$(document).on('click', '.like', function(evt){
+    evt.preventDefault();
+
+    let msg_id = evt.target.id;
+    let liked = !$(`#${msg_id}`).hasClass('btn-warning')
+
+    showLiked(msg_id, liked)
+    pending[msg_id] = liked
+
+    clearTimeout(flushTimer)
+    flushTimer = setTimeout(flushLikes, FLUSH_DELAY)
 })
 
 
@@ -0,0 +1,47 @@
+// Add new messages to the top of the home timeline as they are posted.
+// The stream (see live.py) only says that there are new messages; they
+// are fetched as list items from /timeline/more?since_id=, one request
+// at a time however many arrive meanwhile. A `reset` event means some
+// were missed, which the same fetch catches up on.
+
+let fetching = false
+let stale = false
+
+
+function newestShown($messages) {
+    let ids = $messages.children('[data-message-id]').map(
+        (i, item) => Number($(item).data('message-id'))).get()
+    return Math.max(0, ...ids)
+}
+
+
+async function fetchNew($messages) {
+    if (fetching) {
+        stale = true
+        return
+    }
+
+    fetching = true
+    try {
+        do {
+            stale = false
+            let res = await axios.get($messages.data('since'),
+                                      {params: {since_id: newestShown($messages)}})
+            $messages.prepend(res.data)
+        } while (stale)
+    } finally {
+        fetching = false
+    }
+}
+
+
+$(function() {
+    let $messages = $('#messages[data-live]')
+    if (!$messages.length || !window.EventSource) {
+        return
+    }
+
+    let source = new EventSource($messages.data('live'))
+    source.addEventListener('message', () => fetchNew($messages))
+    source.addEventListener('reset', () => fetchNew($messages))
+})
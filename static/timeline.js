@@ -0,0 +1,11 @@
+// Swap the "Load more" link at the bottom of a timeline for the next page
+// of list items (which ends with its own "Load more" link, if any).
+
+$(document).on('click', '.load-more a', async function(evt){
+    evt.preventDefault();
+
+    let $item = $(this).closest('.load-more');
+    let res = await axios.get($(this).data('more'));
+
+    $item.replaceWith(res.data);
+})
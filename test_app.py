@@ -0,0 +1,52 @@
+"""Application factory tests."""
+
+import gc
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+import app as warbler
+from models import db
+import passwords
+
+
+class CreateAppTestCase(TestCase):
+    """What create_app sets up, and what it leaves until it's needed."""
+
+    def tearDown(self):
+        # create_app points db and passwords at the newest app, outside requests
+        db.app = warbler.app
+        passwords.init_app(warbler.app)
+        gc.unfreeze()
+
+    def test_config(self):
+        app = warbler.create_app({'TIMELINE_FANOUT_LIMIT': 3})
+
+        self.assertEqual(app.config['TIMELINE_FANOUT_LIMIT'], 3)
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], os.environ['DATABASE_URL'])
+        self.assertGreater(app.startup_seconds, 0)
+        self.assertEqual(sorted(map(str, app.url_map.iter_rules())),
+                         sorted(map(str, warbler.app.url_map.iter_rules())))
+        self.assertIn('rebuild-timelines', app.cli.commands)
+
+    def test_lazy(self):
+        app = warbler.create_app()
+
+        self.assertNotIn('debugtoolbar', app.blueprints)
+        self.assertEqual(app.extensions['sqlalchemy'].connectors, {})
+
+        self.assertEqual(app.test_client().get("/").status_code, 200)
+
+    def test_debug_toolbar(self):
+        app = warbler.create_app({'DEBUG': True})
+        self.assertIn('debugtoolbar', app.blueprints)
+
+    def test_preload(self):
+        app = warbler.create_app({'PRELOAD': True})
+
+        loaded = {template.name for template in app.jinja_env.cache.values()}
+        self.assertIn('home.html', loaded)
+        self.assertGreater(gc.get_freeze_count(), 0)
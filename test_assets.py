@@ -0,0 +1,69 @@
+"""Static asset pipeline tests."""
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Fingerprinted, precompressed assets."""
+
+    def setUp(self):
+        self.dist = tempfile.TemporaryDirectory()
+        self.manifest = assets.build(app.static_folder, self.dist.name)
+
+        self.saved = app.config['ASSETS_DIR'], app.extensions['assets']
+        app.config['ASSETS_DIR'] = self.dist.name
+        app.extensions['assets'] = self.manifest
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'], app.extensions['assets'] = self.saved
+        self.dist.cleanup()
+
+    def test_build(self):
+        """Files are named by their content, and stylesheets point at them"""
+        hashed = self.manifest['likes.js']
+        self.assertRegex(hashed, r'^likes\.[0-9a-f]{10}\.js$')
+        self.assertTrue(os.path.exists(os.path.join(self.dist.name, hashed + '.gz')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dist.name, self.manifest['images/nav-bg.png'] + '.gz')))
+
+        with open(os.path.join(self.dist.name, self.manifest['stylesheets/style.css'])) as f:
+            css = f.read()
+        self.assertIn(f'url("/assets/{self.manifest["images/nav-bg.png"]}")', css)
+        self.assertNotIn('/static/images/', css)
+
+        self.assertEqual(assets.build(app.static_folder, self.dist.name), self.manifest)
+
+    def test_serving(self):
+        """Pages link hashed assets, served compressed and cached for good"""
+        resp = self.client.get("/")
+        self.assertIn(f'/assets/{self.manifest["likes.js"]}', str(resp.data))
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=0')
+
+        url = f'/assets/{self.manifest["likes.js"]}'
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], assets.IMMUTABLE)
+        self.assertTrue(resp.mimetype.endswith('/javascript'))
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+        with open(os.path.join(app.static_folder, 'likes.js'), 'rb') as f:
+            self.assertEqual(gzip.decompress(resp.data), f.read())
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+        self.assertEqual(self.client.get('/assets/likes.js').status_code, 404)
@@ -0,0 +1,59 @@
+"""Benchmark harness tests."""
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+os.environ['BENCHMARK_DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from models import db
+import benchmark
+
+db.create_all()
+
+
+class BenchmarkTestCase(TestCase):
+    """Measuring routes and comparing runs."""
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertEqual(benchmark.percentile([7], 95), 7)
+
+    def test_measure(self):
+        counter = benchmark.StatementCounter(db.engine)
+        result = benchmark.measure(app.test_client(), 'GET', '/', 5, counter,
+                                   warmup=1, memory_requests=1)
+
+        self.assertEqual(result['requests'], 5)
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+        self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+        self.assertGreater(result['peak_memory_kb'], 0)
+
+    def test_measure_startup(self):
+        startup = benchmark.measure_startup(runs=1)
+
+        self.assertEqual(set(startup), {'import_ms', 'create_app_ms', 'first_request_ms',
+                                        'process_ms'})
+        self.assertGreater(startup['process_ms'], startup['create_app_ms'])
+
+    def test_compare(self):
+        baseline = {'startup': {'process_ms': 500, 'import_ms': 100}, 'results': [
+            {'size': 10, 'route': 'homepage', 'p95_ms': 10, 'statements': 4},
+            {'size': 10, 'route': 'list_users', 'p95_ms': 10, 'statements': 2},
+        ]}
+        run = {'startup': {'process_ms': 510, 'import_ms': 200}, 'results': [
+            {'size': 10, 'route': 'homepage', 'p95_ms': 11, 'statements': 9},
+            {'size': 10, 'route': 'list_users', 'p95_ms': 30, 'statements': 2},
+            {'size': 99, 'route': 'homepage', 'p95_ms': 99, 'statements': 99},
+        ]}
+
+        self.assertEqual(benchmark.compare(run, baseline, threshold=1.2), [
+            "homepage at 10 users: statements 4 -> 9",
+            "list_users at 10 users: p95_ms 10 -> 30",
+            "startup: import_ms 100 -> 200",
+        ])
@@ -0,0 +1,127 @@
+"""Query plan tests: no route scans a large table."""
+
+import os
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+import current_user
+import instrumentation
+import seed
+import timeline
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExplainTestCase(TestCase):
+    """Every route's statements, EXPLAINed against the seeded sample data."""
+
+    @classmethod
+    def setUpClass(cls):
+        with app.app_context(), redirect_stdout(StringIO()):
+            seed.seed()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.rollback()
+        seed.progress.drop(db.engine, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+
+    def setUp(self):
+        current_user.clear()
+        timeline.forget_pulled_authors()
+        app.config['SQL_EXPLAIN_CHECK'] = True
+        self.client = app.test_client()
+
+        self.viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+        self.popular = User.query.order_by(User.followers_count.desc(), User.id).first()
+        self.message = Message.query.filter(Message.user_id == self.popular.id).first()
+
+    def tearDown(self):
+        app.config['SQL_EXPLAIN_CHECK'] = False
+        db.session.rollback()
+
+    def test_sequential_scans(self):
+        plan = {'Node Type': 'Hash Join', 'Plans': [
+            {'Node Type': 'Seq Scan', 'Relation Name': 'messages'},
+            {'Node Type': 'Index Scan', 'Relation Name': 'users'},
+            {'Node Type': 'Seq Scan', 'Relation Name': 'tiny'},
+        ]}
+        self.assertEqual(instrumentation.sequential_scans(plan, {'messages', 'users'}),
+                         ['messages'])
+
+    def test_foreign_keys_indexed(self):
+        """ON DELETE CASCADE (which EXPLAIN doesn't show) can find rows by index"""
+        for table in db.metadata.sorted_tables:
+            if table.name not in instrumentation.LARGE_TABLES:
+                continue
+
+            leading = {list(table.primary_key.columns)[0].name}
+            leading |= {list(index.columns)[0].name for index in table.indexes}
+            for fk in table.foreign_keys:
+                self.assertIn(fk.parent.name, leading, table.name)
+
+    def test_catches_scans(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+            c.get("/")
+
+            with self.assertRaises(instrumentation.SequentialScan):
+                with app.test_request_context():
+                    db.session.query(Message).filter(Message.text == "x").all()
+                    app.process_response(app.response_class())
+
+    def test_routes_use_indexes(self):
+        viewer, popular, message = self.viewer.id, self.popular.id, self.message.id
+        not_followed = (User
+                        .query
+                        .filter(User.id != viewer,
+                                ~User.id.in_(db.session
+                                             .query(Follows.user_being_followed_id)
+                                             .filter(Follows.user_following_id == viewer)))
+                        .first()
+                        .id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer
+
+            for method, url, data in [
+                ("GET", "/", None),
+                ("GET", f"/timeline/more?before=2019-06-01T00:00:00,{10 ** 6}", None),
+                ("GET", "/api/timeline", None),
+                ("GET", f"/api/timeline?since_id={message}", None),
+                ("GET", f"/users/{popular}", None),
+                ("GET", f"/users/{popular}/messages/more?before=2019-06-01T00:00:00,{10 ** 6}", None),
+                ("GET", f"/users/{viewer}/following", None),
+                ("GET", f"/users/{popular}/followers", None),
+                ("GET", "/users", None),
+                ("GET", f"/users?after={popular}", None),
+                ("GET", "/users?q=an", None),
+                ("GET", "/messages/search?q=story", None),
+                ("GET", f"/messages/{message}", None),
+                ("POST", f"/users/add_like/{message}", None),
+                ("POST", "/api/likes", {"likes": [{"message_id": message, "liked": False}]}),
+                ("POST", f"/users/follow/{not_followed}", None),
+                ("POST", f"/users/stop-following/{not_followed}", None),
+                ("POST", "/messages/new", {"text": "a story"}),
+            ]:
+                if method == "GET":
+                    resp = c.get(url)
+                elif url.startswith("/api/"):
+                    resp = c.post(url, json=data)
+                else:
+                    resp = c.post(url, data=data)
+                self.assertLess(resp.status_code, 400, url)
+
+            new = Message.query.filter(Message.text == "a story").one()
+            resp = c.post(f"/messages/{new.id}/delete")
+            self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,82 @@
+"""Message card fragment cache tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import fragments
+
+db.create_all()
+
+
+class FragmentCacheTestCase(TestCase):
+    """The LRU cache itself."""
+
+    def test_lru_eviction(self):
+        cache = fragments.FragmentCache(max_bytes=100)
+        cache.set('a', 'x' * 8)
+        cache.set('b', 'y' * 8)
+        self.assertEqual(cache.get('a'), 'x' * 8)
+
+        for i in range(20):
+            cache.set(i, 'z' * 5)
+
+        self.assertLessEqual(cache.size, 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get(19), 'z' * 5)
+
+    def test_size_accounting(self):
+        cache = fragments.FragmentCache(max_bytes=100)
+        cache.set('a', 'x' * 8)
+        cache.set('a', 'x' * 4)
+        self.assertEqual((len(cache), cache.size), (1, 4))
+
+        cache.set('big', 'x' * 11)
+        self.assertIsNone(cache.get('big'))
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class MessageCardTestCase(TestCase):
+    """Rendering message lists through the cache."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("author", "author@test.com", "password", None)
+        user.id = 1111
+        db.session.add(Message(id=1, text="<b>hello</b>", user_id=1111))
+        db.session.commit()
+
+        self.cache = app.extensions['fragments']
+        self.cache.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_cards_are_reused(self):
+        """A card renders once, until its author changes"""
+        resp = self.client.get("/users/1111")
+        html = str(resp.data)
+        self.assertIn("&lt;b&gt;hello&lt;/b&gt;", html)
+        self.assertIn("@author", html)
+        self.assertEqual((self.cache.misses, len(self.cache)), (1, 1))
+
+        self.client.get("/users/1111")
+        self.assertEqual(self.cache.hits, 1)
+
+        User.query.get(1111).username = "renamed"
+        db.session.commit()
+
+        resp = self.client.get("/users/1111")
+        self.assertIn("@renamed", str(resp.data))
+        self.assertEqual(self.cache.misses, 2)
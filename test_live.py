@@ -0,0 +1,193 @@
+"""Live timeline update tests."""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+import current_user
+import live
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HubTestCase(TestCase):
+    """Subscriptions and backpressure."""
+
+    def test_deliver(self):
+        hub = live.Hub(queue_size=2, max_streams=1)
+        subscription = hub.subscribe(["messages:1"])
+        self.assertIsNone(hub.subscribe(["messages:1"]))
+
+        hub.deliver("messages:1", {'id': 10})
+        hub.deliver("messages:2", {'id': 11})
+        self.assertEqual(subscription.get(0), ("messages:1", {'id': 10}))
+        self.assertIsNone(subscription.get(0))
+
+        hub.listen(subscription, "messages:2")
+        hub.deliver("messages:2", {'id': 12})
+        self.assertEqual(subscription.get(0), ("messages:2", {'id': 12}))
+
+        hub.unsubscribe(subscription)
+        self.assertEqual((hub.subscriptions, hub.channels), (set(), {}))
+
+    def test_overflow(self):
+        hub = live.Hub(queue_size=2)
+        subscription = hub.subscribe(["messages:1"])
+        for message_id in range(3):
+            hub.deliver("messages:1", {'id': message_id})
+
+        self.assertIs(subscription.get(0), live.RESET)
+        self.assertIsNone(subscription.get(0))
+
+
+class SocketBackendTestCase(TestCase):
+    """Events relayed between processes by the broker."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "live.sock")
+        self.broker = subprocess.Popen(
+            [sys.executable, "-c", f"import live; live.run_broker({self.path!r})"],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self.backends = [live.SocketBackend(live.Hub(), self.path) for _ in range(2)]
+        for backend in self.backends:
+            self.assertTrue(backend.connected.wait(10))
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        self.broker.kill()
+        self.broker.wait()
+        self.dir.cleanup()
+
+    def test_relay(self):
+        sender, receiver = self.backends
+        subscription = receiver.hub.subscribe(["messages:1"])
+        own = sender.hub.subscribe(["messages:1"])
+
+        sender.publish("messages:1", {'id': 5})
+        self.assertEqual(subscription.get(5), ("messages:1", {'id': 5}))
+        self.assertEqual(own.get(5), ("messages:1", {'id': 5}))
+
+        # streams may have missed events while the broker was away
+        self.broker.kill()
+        self.broker.wait()
+        self.assertIs(subscription.get(5), live.RESET)
+
+
+class LiveViewsTestCase(TestCase):
+    """/timeline/stream, and the views that publish to it."""
+
+    def setUp(self):
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.viewer_id, self.author_id, self.other_id = (
+            self.viewer.id, self.author.id, self.other.id)
+        db.session.add(Follows(user_following_id=self.viewer_id,
+                               user_being_followed_id=self.author_id))
+        db.session.commit()
+
+        app.config['LIVE_HEARTBEAT'] = 0.01
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['LIVE_HEARTBEAT'] = live.DEFAULT_HEARTBEAT
+
+    def announce(self, message_id, author_id):
+        with app.app_context():
+            live.announce_message(message_id, author_id)
+
+    def next_event(self, events):
+        """The next chunk of `events` that isn't a heartbeat."""
+        for chunk in events:
+            if chunk != b": heartbeat\n\n":
+                return chunk
+
+    def test_stream(self):
+        resp = self.client.get("/timeline/stream", buffered=False)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        events = iter(resp.response)
+        self.assertEqual(next(events), f"retry: {live.RETRY_MS}\n\n".encode())
+
+        self.announce(41, self.other_id)
+        self.announce(42, self.author_id)
+        self.assertEqual(self.next_event(events),
+                         b'id: 42\ndata: {"id": 42, "user_id": %d}\n\n' % self.author_id)
+
+        # a follow made elsewhere reaches the open stream
+        with app.app_context():
+            live.announce_follow(self.viewer_id, self.other_id)
+        self.assertEqual(next(events), b": heartbeat\n\n")
+        self.announce(43, self.other_id)
+        self.assertTrue(self.next_event(events).startswith(b"id: 43\n"))
+
+        resp.close()
+        with app.app_context():
+            self.assertEqual(live.backend().hub.subscriptions, set())
+
+    def test_stream_limits(self):
+        self.assertEqual(app.test_client().get("/timeline/stream").status_code, 401)
+
+        with app.app_context():
+            hub = live.backend().hub
+        hub.max_streams = 0
+        try:
+            resp = self.client.get("/timeline/stream")
+        finally:
+            hub.max_streams = live.DEFAULT_MAX_STREAMS
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
+
+    def test_posting_announces(self):
+        with app.app_context():
+            subscription = live.subscribe(self.other_id, [self.author_id])
+            hub = live.backend().hub
+
+        try:
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            self.client.post("/messages/new", data={"text": "live"})
+            msg = Message.query.filter(Message.text == "live").one()
+
+            self.assertEqual(subscription.get(0),
+                             (f"messages:{self.author_id}", {'id': msg.id, 'user_id': self.author_id}))
+        finally:
+            hub.unsubscribe(subscription)
+
+    def test_messages_since(self):
+        old, new = Message(text="old", user_id=self.author_id), Message(text="new", user_id=self.author_id)
+        for msg in (old, new):
+            db.session.add(msg)
+            db.session.flush()
+            timeline.deliver_message(msg)
+        db.session.commit()
+
+        resp = self.client.get(f"/timeline/more?since_id={old.id}")
+        html = str(resp.data)
+        self.assertIn(f'data-message-id="{new.id}"', html)
+        self.assertNotIn(f'data-message-id="{old.id}"', html)
+        self.assertNotIn("Load more", html)
+
+        self.assertEqual(self.client.get("/timeline/more?since_id=-1").status_code, 400)
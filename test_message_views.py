@@ -3,13 +3,14 @@
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, connect_db, Message, User
+from models import db, connect_db, Likes, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY, do_logout, IntegrityError
+import current_user
 
 # Create our tables 
 
@@ -19,6 +20,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that runs over its SQL query budget
+
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -26,6 +31,7 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        current_user.clear()
         db.drop_all()
         db.create_all()
 
@@ -145,3 +151,66 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
 
+
+    def test_api_likes(self):
+        """Batches of likes and unlikes apply together, last state winning"""
+        u2 = User.signup("testuser2", "test2@test.com", password="password", image_url=None)
+        u2.id = 123456
+        db.session.add_all([Message(id=i, text=f"warble {i}", user_id=123456) for i in (1, 2, 3)])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.testuser_id, message_id=3))
+        db.session.commit()
+        User.reconcile_counts()
+        db.session.commit()
+
+        resp = self.client.post("/api/likes", json={"likes": []})
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/api/likes", json={"likes": [
+                {"message_id": 1, "liked": True},
+                {"message_id": 2, "liked": True},
+                {"message_id": 2, "liked": False},
+                {"message_id": 3, "liked": False},
+                {"message_id": 404, "liked": True},
+            ]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(sorted((like["message_id"], like["liked"]) for like in resp.json["likes"]),
+                             [(1, True), (2, False), (3, False)])
+
+            liked = {like.message_id for like in Likes.query.filter_by(user_id=self.testuser_id)}
+            self.assertEqual(liked, {1})
+            self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
+
+            for body in [{"likes": [{"message_id": "1", "liked": True}]},
+                         {"likes": [{"message_id": 1, "liked": 1}]},
+                         {"likes": [[1, True]]},
+                         {"likes": {"1": True}},
+                         {"likes": [{"message_id": 1, "liked": True}] * 101}]:
+                self.assertEqual(c.post("/api/likes", json=body).status_code, 400)
+
+    def test_add_like_toggles(self):
+        """Any number of users can like a message; each click toggles one user's like"""
+        u2 = User.signup("testuser2", "test2@test.com", password="password", image_url=None)
+        u2.id = 123456
+        db.session.add(Message(id=1, text="warble", user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            for user_id in (self.testuser_id, 123456):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                self.assertEqual(c.post("/users/add_like/1").data, b"liked")
+
+            self.assertEqual(Likes.query.filter_by(message_id=1).count(), 2)
+
+            self.assertEqual(c.post("/users/add_like/1").data, b"unliked")
+            self.assertEqual([like.user_id for like in Likes.query.filter_by(message_id=1)],
+                             [self.testuser_id])
+            self.assertEqual((User.query.get(self.testuser_id).likes_count,
+                              User.query.get(123456).likes_count), (1, 0))
+
+            self.assertEqual(c.post("/users/add_like/404").status_code, 404)
@@ -0,0 +1,94 @@
+"""/metrics tests."""
+
+import os
+import threading
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from models import db, User
+import current_user
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def parse(text):
+    """{(name, labels): value} of the samples in exposition `text`."""
+
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, _, labels = series.partition('{')
+        samples[name, labels.rstrip('}')] = float(value)
+    return samples
+
+
+class MetricsTestCase(TestCase):
+    """Per-endpoint latency, SQL, template and bcrypt numbers."""
+
+    def setUp(self):
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        metrics.reset()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def scrape(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain; version=0.0.4"))
+        return parse(resp.get_data(as_text=True))
+
+    def test_request_metrics(self):
+        self.client.get("/")
+        self.client.get("/")
+        self.client.post("/login", data={"username": "testuser", "password": "password"})
+        self.client.get("/no/such/page")
+
+        samples = self.scrape()
+        home = 'endpoint="homepage"'
+        self.assertEqual(samples['warbler_request_duration_seconds_count', home], 2)
+        self.assertEqual(samples['warbler_request_duration_seconds_bucket', home + ',le="+Inf"'], 2)
+        self.assertEqual(samples['warbler_requests_total', home + ',status="200"'], 2)
+        self.assertEqual(samples['warbler_requests_total', 'endpoint="unmatched",status="404"'], 1)
+        self.assertGreater(samples['warbler_template_seconds_total', home], 0)
+        self.assertEqual(samples['warbler_bcrypt_seconds_total', home], 0)
+
+        login = 'endpoint="login"'
+        self.assertGreater(samples['warbler_bcrypt_seconds_total', login], 0)
+        self.assertGreater(samples['warbler_sql_statements_total', login], 0)
+        self.assertGreater(samples['warbler_sql_seconds_total', login], 0)
+        self.assertIn(('warbler_db_pool_checkouts_total', ''), samples)
+
+        buckets = [samples['warbler_request_duration_seconds_bucket', f'{login},le="{bound}"']
+                   for bound in metrics.BUCKETS + ('+Inf',)]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 1)
+
+    def test_threads_add_up(self):
+        self.client.get("/")
+        thread = threading.Thread(target=lambda: app.test_client().get("/"))
+        thread.start()
+        thread.join()
+
+        samples = self.scrape()
+        self.assertEqual(samples['warbler_request_duration_seconds_count', 'endpoint="homepage"'], 2)
+
+    def test_remote_scrape(self):
+        resp = self.client.get("/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"})
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,85 @@
+"""Connection pool settings and statistics tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from models import db
+import pools
+
+
+class TimedQueuePoolTestCase(TestCase):
+    """Counting waits, timeouts and churn."""
+
+    def setUp(self):
+        self.engine = create_engine("postgresql:///warbler_test", poolclass=pools.TimedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_counts(self):
+        conn = self.engine.connect()
+        stats = self.engine.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['checked_out'], stats['connects']), (1, 1, 1))
+
+        with self.assertRaises(exc.TimeoutError):
+            self.engine.connect()
+
+        stats = self.engine.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['timeouts']), (2, 1))
+        self.assertGreaterEqual(stats['max_checkout_wait_ms'], 100)
+
+        conn.invalidate()
+        conn.close()
+        self.engine.connect().close()
+        stats = self.engine.pool.stats()
+        self.assertEqual((stats['invalidations'], stats['connects'], stats['checked_out']), (1, 2, 0))
+
+    def test_forked_connections_replaced(self):
+        conn = self.engine.connect()
+        conn.connection._connection_record.info['pid'] = -1
+        conn.close()
+
+        conn = self.engine.connect()
+        self.assertEqual(conn.connection._connection_record.info['pid'], os.getpid())
+        conn.close()
+        self.assertEqual(self.engine.pool.stats()['connects'], 2)
+
+    def test_dispose_keeps_counting(self):
+        self.engine.connect().close()
+        self.engine.dispose()
+        self.engine.connect().close()
+
+        stats = self.engine.pool.stats()
+        self.assertEqual((stats['checkouts'], stats['connects']), (2, 2))
+
+
+class PoolSettingsTestCase(TestCase):
+    """The app's engine and /internal/pool."""
+
+    def test_engine_uses_settings(self):
+        pool = db.engine.pool
+        self.assertIsInstance(pool, pools.TimedQueuePool)
+        self.assertEqual(pool.size(), app.config['DB_POOL_SIZE'])
+        self.assertEqual(pool._recycle, app.config['DB_POOL_RECYCLE'])
+        self.assertTrue(pool._pre_ping)
+
+        self.assertEqual(pools.engine_options(app, "sqlite:///warbler.db"), {})
+
+    def test_stats_endpoint(self):
+        client = app.test_client()
+
+        resp = client.get("/internal/pool")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("checkout_wait_ms", resp.json["primary"])
+        self.assertEqual(resp.json["replicas"], {})
+
+        resp = client.get("/internal/pool", environ_base={"REMOTE_ADDR": "10.1.2.3"})
+        self.assertEqual(resp.status_code, 404)
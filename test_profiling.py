@@ -0,0 +1,64 @@
+"""Sampled request profiling tests."""
+
+import os
+import pstats
+import sys
+import tempfile
+from glob import glob
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from models import db
+import current_user
+import profiling
+
+db.create_all()
+
+
+class ProfilingTestCase(TestCase):
+    """Which requests are profiled, and what is written for them."""
+
+    def setUp(self):
+        current_user.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.dir.name
+        self.client = app.test_client()
+        self.header = {app.config['PROFILE_HEADER']: profiling.make_token(app)}
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        app.config['PROFILE_MODE'] = 'sample'
+        self.dir.cleanup()
+
+    def profiles(self, endpoint, extension):
+        return glob(os.path.join(self.dir.name, endpoint, f"*.{extension}"))
+
+    def test_off_by_default(self):
+        self.client.get("/")
+        self.client.get("/", headers={app.config['PROFILE_HEADER']: "forged"})
+        self.assertEqual(os.listdir(self.dir.name), [])
+
+    def test_signed_header(self):
+        app.config['PROFILE_MODE'] = 'cprofile'
+        self.client.get("/", headers=self.header)
+
+        [path] = self.profiles("homepage", "pstats")
+        functions = {name for _, _, name in pstats.Stats(path).stats}
+        self.assertIn("homepage", functions)
+
+    def test_sample_rate(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.client.get("/")
+        self.client.get("/")
+
+        self.assertEqual(len(self.profiles("homepage", "collapsed")), 2)
+
+    def test_collapse(self):
+        stack = profiling.collapse(sys._getframe())
+        self.assertTrue(stack.endswith(f"test_collapse (test_profiling.py:"
+                                       f"{self.test_collapse.__code__.co_firstlineno})"))
+        self.assertIn(";", stack)
@@ -0,0 +1,97 @@
+"""Read replica routing tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from models import db, User
+import current_user
+import replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    """GET views read from a replica (an SQLite file here) unless the
+    client has just written."""
+
+    def setUp(self):
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        User.signup("testuser", "test@test.com", "password", None).id = 9999
+        User.signup("other", "other@test.com", "password", None).id = 1234
+        db.session.commit()
+
+        # the replica is behind: it has testuser, but not as they are now
+        self.dir = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{os.path.join(self.dir.name, 'replica.db')}"
+        engine = create_engine(url)
+        db.metadata.create_all(engine)
+        session = Session(bind=engine)
+        session.add_all([User(id=9999, username="stale", email="test@test.com", password="x"),
+                         User(id=42, username="replicated", email="r@test.com", password="x")])
+        session.commit()
+        session.close()
+        engine.dispose()
+
+        app.config['SQLALCHEMY_REPLICA_URLS'] = [url]
+        app.config['REPLICA_STICKY_SECONDS'] = 60
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['SQLALCHEMY_REPLICA_URLS'] = []
+        for engine in app.extensions['replicas'].values():
+            engine.dispose()
+        app.extensions['replicas'].clear()
+        self.dir.cleanup()
+
+    def test_reads_from_replica(self):
+        resp = self.client.get("/users/42")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@replicated", str(resp.data))
+
+        # not a replica_reads view
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 9999
+            resp = c.get("/messages/new")
+            self.assertIn("testuser", str(resp.data))
+
+    def test_no_replicas(self):
+        app.config['SQLALCHEMY_REPLICA_URLS'] = []
+        self.assertEqual(self.client.get("/users/42").status_code, 404)
+
+    def test_reads_own_writes(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 9999
+
+            self.assertIn("@stale", str(c.get("/users/9999").data))
+
+            # the write goes to the primary...
+            resp = c.post("/users/follow/1234")
+            self.assertEqual(resp.status_code, 302)
+            with c.session_transaction() as sess:
+                self.assertIn(replicas.LAST_WRITE_KEY, sess)
+
+            # ...and so do this client's reads, for a while
+            current_user.clear()
+            resp = c.get("/users/9999/following")
+            self.assertIn("@other", str(resp.data))
+            self.assertEqual(c.get("/users/42").status_code, 404)
+
+            app.config['REPLICA_STICKY_SECONDS'] = 0
+            self.assertEqual(c.get("/users/42").status_code, 200)
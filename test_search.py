@@ -0,0 +1,201 @@
+"""User and message search tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from models import db, Message, MessageTerm, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import current_user
+import search
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
+
+NAMES = ["jo", "Johnny", "john_doe", "jon", "alice", "bob"]
+
+
+class SearchTestCase(TestCase):
+    """Ranked, paged username search."""
+
+    def setUp(self):
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all(User(id=i + 1, username=name, email=f"{name}@test.com",
+                                password="not a hash")
+                           for i, name in enumerate(NAMES))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_prefix_search(self):
+        """Usernames starting with the search text, exact match first"""
+        users, has_more = search.search_users("JO")
+        self.assertEqual([u.username for u in users], ["jo", "john_doe", "Johnny", "jon"])
+        self.assertFalse(has_more)
+
+        users, _ = search.search_users("joh")
+        self.assertEqual([u.username for u in users], ["john_doe", "Johnny"])
+
+        self.assertEqual(search.search_users("x%")[0], [])
+
+    def test_search_pages(self):
+        """Results come a page at a time"""
+        users, has_more = search.search_users("jo", page=1, per_page=3)
+        self.assertEqual([u.username for u in users], ["jo", "john_doe", "Johnny"])
+        self.assertTrue(has_more)
+
+        users, has_more = search.search_users("jo", page=2, per_page=3)
+        self.assertEqual([u.username for u in users], ["jon"])
+        self.assertFalse(has_more)
+
+        with self.client as c:
+            resp = c.get("/users", query_string={"q": "jo"})
+            html = str(resp.data)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@john_doe", html)
+            self.assertNotIn("@alice", html)
+
+            resp = c.get("/users", query_string={"q": "jo", "page": 0})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_uses_index(self):
+        """Searches are an index range scan on PostgreSQL"""
+        query = search.matching_users(db.session, "jo").limit(25)
+        sql = str(query.statement.compile(dialect=db.engine.dialect,
+                                          compile_kwargs={"literal_binds": True}))
+
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        plan = "\n".join(row[0] for row in db.session.execute("EXPLAIN " + sql))
+        self.assertIn("ix_users_username_search", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_sqlite_search(self):
+        """The SQLite backend matches word prefixes through FTS5"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        session = Session(bind=engine)
+
+        session.add_all(User(id=i + 1, username=name, email=f"{name}@test.com",
+                             password="not a hash")
+                        for i, name in enumerate(NAMES))
+        session.commit()
+
+        names = {u.username for u in search.matching_users(session, "jo")}
+        self.assertEqual(names, {"jo", "Johnny", "john_doe", "jon"})
+
+        names = [u.username for u in search.matching_users(session, "doe")]
+        self.assertEqual(names, ["john_doe"])
+
+        session.query(User).filter(User.username == "bob").update({User.username: "doe"})
+        session.commit()
+        names = {u.username for u in search.matching_users(session, "doe")}
+        self.assertEqual(names, {"doe", "john_doe"})
+
+        session.close()
+
+
+class MessageSearchTestCase(TestCase):
+    """Full-text message search."""
+
+    def setUp(self):
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        user = User(id=1, username="author", email="author@test.com", password="not a hash")
+        db.session.add(user)
+        db.session.add_all([
+            Message(id=101, text="The quick brown fox", user_id=1),
+            Message(id=102, text="foxes, foxes everywhere: fox fox", user_id=1),
+            Message(id=103, text="a lazy dog", user_id=1),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_search_messages(self):
+        """Matching messages, most relevant first"""
+        messages, has_more = search.search_messages("fox")
+        self.assertEqual([m.id for m in messages], [102, 101])
+        self.assertFalse(has_more)
+
+        self.assertEqual([m.id for m in search.search_messages("quick fox")[0]], [101])
+        self.assertEqual(search.search_messages("cat")[0], [])
+        self.assertEqual(search.search_messages("  ")[0], [])
+
+        messages, has_more = search.search_messages("fox", page=1, per_page=1)
+        self.assertEqual(([m.id for m in messages], has_more), ([102], True))
+
+    def test_search_uses_index(self):
+        """Searches read the GIN index on PostgreSQL"""
+        query = search.matching_messages(db.session, "fox")
+        sql = str(query.statement.compile(dialect=db.engine.dialect,
+                                          compile_kwargs={"literal_binds": True}))
+
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        plan = "\n".join(row[0] for row in db.session.execute("EXPLAIN " + sql))
+        self.assertIn("ix_messages_text_search", plan)
+
+    def test_search_view(self):
+        """/messages/search shows matches, and new and deleted messages"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.post("/messages/new", data={"text": "Zebras are striped"})
+            resp = c.get("/messages/search", query_string={"q": "zebra"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Zebras are striped", str(resp.data))
+
+            msg = Message.query.filter(Message.text.startswith("Zebras")).one()
+            c.post(f"/messages/{msg.id}/delete")
+            resp = c.get("/messages/search", query_string={"q": "zebra"})
+            self.assertIn("no warbles found", str(resp.data))
+
+            resp = c.get("/messages/search", query_string={"q": "fox", "page": -1})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_posting_lists(self):
+        """Other databases search the message_terms posting lists"""
+        engine = create_engine("sqlite://")
+        db.metadata.create_all(engine)
+        session = Session(bind=engine)
+
+        session.add(User(id=1, username="author", email="author@test.com", password="x"))
+        messages = [Message(id=1, text="The quick brown fox", user_id=1),
+                    Message(id=2, text="foxes, fox fox", user_id=1),
+                    Message(id=3, text="a lazy dog", user_id=1)]
+        session.add_all(messages)
+        session.flush()
+        for msg in messages:
+            search.index_message(session, msg)
+
+        self.assertEqual([m.id for m in search.matching_messages(session, "FOX")], [2, 1])
+        self.assertEqual([m.id for m in search.matching_messages(session, "quick fox")], [1])
+
+        search.unindex_message(session, messages[1])
+        session.delete(messages[1])
+        self.assertEqual([m.id for m in search.matching_messages(session, "fox")], [1])
+
+        search.reindex_messages(session)
+        self.assertEqual(session.query(MessageTerm).filter(MessageTerm.term == "fox").count(), 1)
+
+        session.close()
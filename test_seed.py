@@ -0,0 +1,100 @@
+"""Bulk loader tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+import psycopg2
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import seed
+
+USERS = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,,hash,,,
+b@test.com,bob,,hash,"bio, with a comma",,
+c@test.com,carol,,hash,,,
+"""
+
+MESSAGES = """text,timestamp,user_id
+hello,2020-01-01 00:00:00,1
+"quoted, text",2020-01-02 00:00:00,2
+"""
+
+FOLLOWS = """user_being_followed_id,user_following_id
+1,2
+2,3
+"""
+
+
+class SeedTestCase(TestCase):
+    """Chunked, resumable CSV loads."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.saved_sources = seed.SOURCES
+        seed.SOURCES = [(self.write(name, content), table)
+                        for name, content, table in [("users.csv", USERS, User.__table__),
+                                                     ("messages.csv", MESSAGES, Message.__table__),
+                                                     ("follows.csv", FOLLOWS, Follows.__table__)]]
+
+    def tearDown(self):
+        db.session.rollback()
+        seed.SOURCES = self.saved_sources
+        self.dir.cleanup()
+        seed.progress.drop(db.engine, checkfirst=True)
+        db.drop_all()
+        db.create_all()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_seed(self):
+        """Everything loads, with indexes, timelines and counts built after"""
+        with app.app_context():
+            seed.seed(chunk_size=2)
+
+        self.assertEqual([u.username for u in User.query.order_by(User.id)], ["alice", "bob", "carol"])
+        self.assertEqual(User.query.get(2).bio, "bio, with a comma")
+        self.assertEqual(Message.query.get(2).text, "quoted, text")
+        self.assertEqual(User.query.get(1).followers_count, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2, message_id=1).count(), 1)
+
+        index_names = {name for (name,) in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")}
+        self.assertIn("ix_messages_user_id_timestamp", index_names)
+        self.assertIn("ix_messages_text_search", index_names)
+
+        # new rows get ids after the loaded ones
+        msg = Message(text="new", user_id=1)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.id, 3)
+
+    def test_resume(self):
+        """A failed load carries on from the last committed chunk"""
+        follows_path = seed.SOURCES[2][0]
+        self.write("follows.csv", FOLLOWS + "1,99\n")
+
+        with app.app_context(), self.assertRaises(psycopg2.IntegrityError):
+            seed.seed(chunk_size=2)
+
+        self.assertEqual(Follows.query.count(), 2)
+
+        self.write("follows.csv", FOLLOWS + "1,3\n")
+        with app.app_context():
+            seed.seed(resume=True, chunk_size=2)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 2)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(User.query.get(1).followers_count, 2)
+        self.assertEqual(seed.SOURCES[2][0], follows_path)
@@ -0,0 +1,284 @@
+"""Home timeline tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import current_user
+import instrumentation
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Fail any view that runs over its SQL query budget
+
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out and reading of home timelines."""
+
+    def setUp(self):
+        """Create two users, with `follower` following `author`."""
+
+        current_user.clear()
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        app.config['TIMELINE_FANOUT_LIMIT'] = timeline.DEFAULT_FANOUT_LIMIT
+        timeline.forget_pulled_authors()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        author.id = 1111
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        follower.id = 2222
+        db.session.commit()
+
+        self.author_id = author.id
+        self.follower_id = follower.id
+
+        self.follow(self.follower_id, self.author_id)
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def follow(self, follower_id, followed_id, stop=False):
+        action = "stop-following" if stop else "follow"
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            return c.post(f"/users/{action}/{followed_id}")
+
+    def post_as_author(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one()
+
+    def timeline_ids(self, user_id, cursor=None):
+        with app.app_context():
+            user = User.query.get(user_id)
+            return [msg.id for msg in timeline.home_messages(user, cursor=cursor)]
+
+    def test_post_fans_out(self):
+        msg = self.post_as_author("Hello followers")
+
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+        self.assertEqual(self.timeline_ids(self.author_id), [msg.id])
+
+    def test_high_fanout_author_is_pulled(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        with app.app_context():
+            timeline.rebuild_timelines()
+            db.session.commit()
+
+        msg = self.post_as_author("Too famous to fan out")
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.follower_id).count(), 0)
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        other = User.signup("other", "other@test.com", "password", None)
+        other.id = 3333
+        db.session.commit()
+
+        m = Message(id=1234, text="An older message", user_id=other.id)
+        db.session.add(m)
+        db.session.commit()
+
+        self.follow(self.follower_id, 3333)
+        self.assertEqual(self.timeline_ids(self.follower_id), [1234])
+
+        self.follow(self.follower_id, 3333, stop=True)
+        self.assertEqual(self.timeline_ids(self.follower_id), [])
+
+    def test_author_crossing_limit_switches_mode(self):
+        """Messages posted while pulled are backfilled once pushed again"""
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        other = User.signup("other", "other@test.com", "password", None)
+        other.id = 3333
+        db.session.commit()
+
+        self.follow(3333, self.author_id)
+        self.assertEqual(User.query.get(self.author_id).followers_count, 2)
+        self.assertTrue(User.query.get(self.author_id).fanout_pulled)
+
+        msg = self.post_as_author("Posted while pulled")
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.follower_id).count(), 0)
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+
+        self.follow(3333, self.author_id, stop=True)
+        self.assertFalse(User.query.get(self.author_id).fanout_pulled)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.follower_id).count(), 1)
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+
+    def test_self_follow(self):
+        resp = self.follow(self.author_id, self.author_id)
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follows.query.filter_by(user_following_id=self.author_id).count(), 0)
+
+        # a self-follow already in the table must not break fan-out or rebuilds
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.author_id))
+        db.session.commit()
+
+        msg = self.post_as_author("Talking to myself")
+        self.assertEqual(self.timeline_ids(self.author_id), [msg.id])
+
+        with app.app_context():
+            timeline.rebuild_timelines()
+            db.session.commit()
+
+        self.assertEqual(self.timeline_ids(self.author_id), [msg.id])
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+
+    def test_deleted_message_leaves_timelines(self):
+        msg = self.post_as_author("Soon gone")
+        self.assertEqual(self.timeline_ids(self.follower_id), [msg.id])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            c.post(f"/messages/{msg.id}/delete")
+
+        self.assertEqual(self.timeline_ids(self.follower_id), [])
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild_timelines(self):
+        m = Message(id=1234, text="Loaded in bulk", user_id=self.author_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with app.app_context():
+            timeline.rebuild_timelines()
+            db.session.commit()
+
+        self.assertEqual(self.timeline_ids(self.follower_id), [1234])
+        self.assertEqual(self.timeline_ids(self.author_id), [1234])
+
+    def test_cursor_pages_across_pulled_authors(self):
+        other = User.signup("other", "other@test.com", "password", None)
+        other.id = 3333
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(id=1, text="one", timestamp=start, user_id=self.author_id),
+            Message(id=2, text="two", timestamp=start + timedelta(1), user_id=other.id),
+            Message(id=3, text="three", timestamp=start + timedelta(2), user_id=self.author_id),
+        ])
+        follower = User.query.get(self.follower_id)
+        follower.following.append(other)
+        db.session.commit()
+
+        # with a limit of 0 both authors are pulled at read time, so the
+        # follower's inbox is empty and every message comes from the merge
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        with app.app_context():
+            timeline.rebuild_timelines()
+            db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.follower_id).count(), 0)
+        self.assertEqual(self.timeline_ids(self.follower_id), [3, 2, 1])
+        self.assertEqual(
+            self.timeline_ids(self.follower_id, cursor=(start + timedelta(2), 3)),
+            [2, 1])
+
+    def test_home_within_query_budget(self):
+        """Rendering a page of messages from many authors is not N+1"""
+        for i in range(10):
+            u = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+            u.id = 5000 + i
+        db.session.commit()
+
+        for i in range(10):
+            db.session.add(Message(text=f"warble {i}", user_id=5000 + i))
+            db.session.add(Follows(user_being_followed_id=5000 + i,
+                                   user_following_id=self.follower_id))
+        db.session.commit()
+
+        with app.app_context():
+            timeline.rebuild_timelines()
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.follower_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warble 9", str(resp.data))
+            self.assertLessEqual(instrumentation.statement_count(), 8)
+
+            homepage = app.view_functions['homepage']
+            homepage.query_budget = 1
+            try:
+                resp = c.get("/")
+            finally:
+                homepage.query_budget = 8
+
+            self.assertEqual(resp.status_code, 500)
+
+    def test_api_timeline(self):
+        """The JSON timeline answers 304 until messages or follows change"""
+        self.post_as_author("first")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.follower_id
+
+            resp = c.get("/api/timeline")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m["text"] for m in resp.json["messages"]], ["first"])
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+            etag = resp.headers["ETag"]
+            first_id = resp.json["messages"][0]["id"]
+
+            resp = c.get("/api/timeline", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+        self.post_as_author("second")
+
+        with self.client as c:
+            resp = c.get("/api/timeline", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/api/timeline", query_string={"since_id": first_id})
+            self.assertEqual([m["text"] for m in resp.json["messages"]], ["second"])
+
+            resp = c.get("/api/timeline", query_string={"since_id": -1})
+            self.assertEqual(resp.status_code, 400)
+
+        self.follow(self.follower_id, self.author_id, stop=True)
+
+        with self.client as c:
+            resp = c.get("/api/timeline", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["messages"], [])
+
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            self.assertEqual(c.get("/api/timeline").status_code, 401)
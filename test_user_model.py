@@ -10,6 +10,7 @@ from unittest import TestCase
 from sqlalchemy import exc 
 
 from models import db, User, Message, Follows
+import passwords
 
 
 # BEFORE we import our app, let's set an environmental variable
@@ -23,6 +24,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app
 
+# Cheap password hashes keep the tests fast
+
+app.config['BCRYPT_LOG_ROUNDS'] = 4
+
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -107,6 +112,28 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.u2.is_followed_by(self.u1))
         self.assertFalse(self.u1.is_followed_by(self.u2))
 
+    def test_follow_state(self):
+        """Follow state for a page of users is loaded as sets"""
+        u3 = User.signup("test3", "fake3@email.com", "password", None)
+        u3.id = 3333
+        self.u1.following.append(self.u2)
+        u3.following.append(self.u1)
+        db.session.commit()
+
+        state = self.u1.follow_state
+        state.load([self.u2.id, u3.id])
+        self.assertEqual(state.following, {self.u2.id})
+        self.assertEqual(state.followers, {u3.id})
+
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertFalse(self.u1.is_following(u3))
+        self.assertTrue(self.u1.is_followed_by(u3))
+
+        #changing follows drops the cached state
+        self.u1.following.append(u3)
+        db.session.commit()
+        self.assertTrue(self.u1.is_following(u3))
+
     #########
     #Test sign-ups#
     #########
@@ -167,3 +194,19 @@ class UserModelTestCase(TestCase):
     
         
 
+    def test_authenticate_rehashes(self):
+        """Logging in upgrades a hash made with another work factor"""
+        old_hash = self.u1.password
+        self.assertFalse(passwords.needs_rehash(old_hash))
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        try:
+            self.assertTrue(passwords.needs_rehash(old_hash))
+
+            u = User.authenticate(self.u1.username, "password")
+            self.assertEqual(u, self.u1)
+            self.assertTrue(u.password.startswith("$2b$05$"))
+            self.assertTrue(passwords.check_password(u.password, "password"))
+            self.assertFalse(User.authenticate(self.u1.username, "wrong"))
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = 4
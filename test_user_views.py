@@ -1,10 +1,14 @@
 """User View tests."""
 
 from app import app, CURR_USER_KEY, do_logout, IntegrityError
+import current_user
 import os
 from unittest import TestCase
 from sqlalchemy import exc
-from models import db, connect_db, Message, User
+from models import db, connect_db, Follows, Message, User
+from datetime import datetime, timedelta
+from pagination import PAGE_SIZE, make_cursor
+from search import USERS_PER_PAGE
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
@@ -19,6 +23,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that runs over its SQL query budget
+
+app.config['SQL_QUERY_BUDGET_STRICT'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for messages."""
@@ -26,6 +34,7 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        current_user.clear()
         db.drop_all()
         db.create_all()
 
@@ -90,6 +99,42 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("testuser", str(resp.data))
 
+    def test_users_directory(self):
+        """/users lists users a page at a time, or streams all of them"""
+        for i in range(USERS_PER_PAGE + 5):
+            u = User.signup(f"member{i:02}", f"member{i}@test.com", "password", None)
+            u.id = 10000 + i
+        db.session.commit()
+        db.session.add(Follows(user_following_id=self.testuser_id, user_being_followed_id=10001))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/users")
+            html = str(resp.data)
+            self.assertIn("@testuser<", html)
+            self.assertIn(f"@member{USERS_PER_PAGE - 2:02}<", html)
+            self.assertNotIn(f"@member{USERS_PER_PAGE - 1:02}<", html)
+            self.assertIn(f"/users?after={10000 + USERS_PER_PAGE - 2}", html)
+
+            resp = c.get("/users", query_string={"after": 10000 + USERS_PER_PAGE - 2})
+            html = str(resp.data)
+            self.assertIn(f"@member{USERS_PER_PAGE + 4}<", html)
+            self.assertNotIn("@testuser<", html)
+            self.assertNotIn("Next", html)
+
+            self.assertEqual(c.get("/users", query_string={"after": -1}).status_code, 400)
+
+            resp = c.get("/users", query_string={"stream": 1})
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+            self.assertIn("@testuser<", html)
+            self.assertIn(f"@member{USERS_PER_PAGE + 4}<", html)
+            self.assertEqual(html.count("Unfollow"), 1)
+            self.assertEqual(html.count(">Follow<"), USERS_PER_PAGE + 4)
+
     def test_users_show(self):
         """Show a users profile"""
         with self.client as c:
@@ -99,6 +144,137 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser", str(resp.data))
             self.assertIn("Likes", str(resp.data))
 
+    def test_users_show_pages(self):
+        """Profile shows only the user's own messages, a page at a time"""
+        u2 = User.signup("testuser2", "test2@test.com", password="password", image_url=None)
+        u2.id = 123456
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        messages = [Message(id=i + 1, text=f"warble {i}", timestamp=start + timedelta(minutes=i),
+                            user_id=self.testuser_id)
+                    for i in range(PAGE_SIZE + 5)]
+        messages.append(Message(id=1000, text="not mine", user_id=u2.id))
+        db.session.add_all(messages)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users/9999")
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"warble {PAGE_SIZE + 4}<", html)
+            self.assertNotIn("warble 4<", html)
+            self.assertNotIn("not mine", html)
+            self.assertIn("Load more", html)
+
+            cursor = make_cursor(Message.query.get(6))
+            resp = c.get("/users/9999/messages/more", query_string={"before": cursor})
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warble 4<", html)
+            self.assertIn("warble 0<", html)
+            self.assertNotIn("warble 5<", html)
+            self.assertNotIn("Load more", html)
+
+            resp = c.get("/users/9999", query_string={"before": "yesterday"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/users/9999", query_string={"before": "2020-01-01T00:00:00,99999999999"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.get("/users/4242/messages/more")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_counts(self):
+        """Profile counters follow messages, follows and likes"""
+        u2 = User.signup("testuser2", "test2@test.com", password="password", image_url=None)
+        u2.id = 123456
+        m = Message(id=1234, text="like me", user_id=u2.id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/users/follow/123456")
+            c.post("/messages/new", data={"text": "Hello"})
+            c.post("/users/add_like/1234")
+
+            me = User.query.get(self.testuser_id)
+            u2 = User.query.get(123456)
+            self.assertEqual((me.messages_count, me.following_count, me.followers_count, me.likes_count),
+                             (1, 1, 0, 1))
+            self.assertEqual((u2.messages_count, u2.following_count, u2.followers_count, u2.likes_count),
+                             (0, 0, 1, 0))
+
+            resp = c.get("/users/9999")
+            self.assertIn('<a href="/users/9999/following">1</a>', str(resp.data))
+
+            # scramble the counters and check they can be rebuilt
+            User.query.update({User.likes_count: 42, User.messages_count: 42})
+            db.session.commit()
+            User.reconcile_counts()
+            db.session.commit()
+
+            me = User.query.get(self.testuser_id)
+            self.assertEqual((me.messages_count, me.likes_count), (1, 1))
+
+            c.post("/users/stop-following/123456")
+            c.post("/users/add_like/1234")
+
+            me = User.query.get(self.testuser_id)
+            self.assertEqual((me.following_count, me.likes_count), (0, 0))
+            self.assertEqual(User.query.get(123456).followers_count, 0)
+
+    def test_delete_user_releases_counts(self):
+        """Deleting a user takes their follows and liked messages out of other users' counts"""
+        u2 = User.signup("testuser2", "test2@test.com", password="password", image_url=None)
+        u2.id = 123456
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/messages/new", data={"text": "Hello"})
+            c.post("/users/follow/123456")
+            msg_id = Message.query.one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 123456
+            c.post("/users/follow/9999")
+            c.post(f"/users/add_like/{msg_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            u2 = User.query.get(123456)
+            self.assertEqual((u2.following_count, u2.followers_count, u2.likes_count), (0, 0, 0))
+            self.assertIsNone(User.query.get(self.testuser_id))
+
+    def test_current_user_cache(self):
+        """g.user is reused between requests and refreshed after a profile edit"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.get("/")
+
+            User.query.filter(User.id == self.testuser_id).update({User.username: "changed-elsewhere"})
+            db.session.commit()
+
+            resp = c.get("/")
+            self.assertIn("@testuser", str(resp.data))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            resp = c.get("/")
+            self.assertIn("@renamed", str(resp.data))
+
     #Following/follower tests
     ######
     def test_logged_out_view_following(self):
@@ -0,0 +1,361 @@
+"""Materialized home timelines for Warbler.
+
+Each user has an inbox of rows in the `timelines` table. Rows are written
+when a message is posted ("fan-out on write") and when the user follows
+someone, and removed when they unfollow. Reading the home page is then a
+single range scan over the viewer's inbox.
+
+Authors with more than TIMELINE_FANOUT_LIMIT followers are switched to
+"pulled": their messages are only written to their own timeline, and
+followers merge them in at read time. The mode is stored on the author
+(`User.fanout_pulled`) and only changes when a follow or unfollow moves
+their follower count across the limit, so writes and reads always agree.
+An author goes back to being pushed once they drop below 90% of the
+limit, and their recent messages are then copied into followers' inboxes.
+"""
+
+import heapq
+import time
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import literal
+from sqlalchemy.orm import aliased, joinedload
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import before
+
+DEFAULT_FANOUT_LIMIT = 10000
+BACKFILL_SIZE = 100
+
+# How long each process trusts its cached set of pulled authors.
+PULLED_AUTHORS_TTL = 30
+
+TIMELINE_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+_pulled_authors = {'ids': frozenset(), 'expires': 0}
+
+
+def fanout_limit():
+    """Follower count above which an author's messages are pulled, not pushed."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT', DEFAULT_FANOUT_LIMIT)
+
+
+def push_limit():
+    """Follower count at or below which a pulled author is pushed again."""
+
+    limit = fanout_limit()
+    return limit - limit // 10
+
+
+def is_high_fanout(user_id):
+    """Are `user_id`'s messages pulled by followers instead of pushed?"""
+
+    pulled = (db.session
+              .query(User.fanout_pulled)
+              .filter(User.id == user_id)
+              .scalar())
+    return bool(pulled)
+
+
+def pulled_authors():
+    """IDs of every pulled author, cached per process for a short while."""
+
+    now = time.monotonic()
+    if now >= _pulled_authors['expires']:
+        rows = db.session.query(User.id).filter(User.fanout_pulled).all()
+        _pulled_authors['ids'] = frozenset(user_id for (user_id,) in rows)
+        _pulled_authors['expires'] = now + PULLED_AUTHORS_TTL
+
+    return _pulled_authors['ids']
+
+
+def forget_pulled_authors():
+    """Drop this process's cached set of pulled authors."""
+
+    _pulled_authors['expires'] = 0
+
+
+def deliver_message(msg):
+    """Add a newly-flushed `msg` to its author's and followers' timelines."""
+
+    table = TimelineEntry.__table__
+
+    db.session.execute(table.insert().values(
+        user_id=msg.user_id,
+        message_id=msg.id,
+        author_id=msg.user_id,
+        timestamp=msg.timestamp,
+    ))
+
+    if is_high_fanout(msg.user_id):
+        return
+
+    followers = (db.session
+                 .query(Follows.user_following_id,
+                        literal(msg.id),
+                        literal(msg.user_id),
+                        literal(msg.timestamp, db.DateTime))
+                 .filter(Follows.user_being_followed_id == msg.user_id,
+                         Follows.user_following_id != msg.user_id))
+
+    db.session.execute(
+        table.insert().from_select(TIMELINE_COLUMNS, followers.statement))
+
+
+def follow_added(follower_id, followed_id):
+    """Update counts and timelines after `follower_id` follows `followed_id`."""
+
+    User.adjust_counts(follower_id, follows_changed=True, following=1)
+    User.adjust_counts(followed_id, followers=1)
+
+    if not sync_fanout_mode(followed_id):
+        backfill_follow(follower_id, followed_id)
+
+
+def follow_removed(follower_id, followed_id):
+    """Update counts and timelines after `follower_id` unfollows `followed_id`."""
+
+    User.adjust_counts(follower_id, follows_changed=True, following=-1)
+    User.adjust_counts(followed_id, followers=-1)
+    remove_follow(follower_id, followed_id)
+    sync_fanout_mode(followed_id)
+
+
+def sync_fanout_mode(user_id):
+    """Switch `user_id` between pushed and pulled if their follower count
+    has crossed the limit. Returns whether they are pulled afterwards.
+
+    Inbox rows pushed before a switch to pulled are left in place; the
+    read side skips duplicates, so nothing disappears while other
+    processes still have the old mode cached.
+    """
+
+    followers_count, pulled = (db.session
+                               .query(User.followers_count, User.fanout_pulled)
+                               .filter(User.id == user_id)
+                               .one())
+
+    if not pulled and followers_count > fanout_limit():
+        _set_pulled(user_id, True)
+        return True
+
+    if pulled and followers_count <= push_limit():
+        _set_pulled(user_id, False)
+        _backfill_followers(user_id)
+        return False
+
+    return pulled
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy the recent messages of `followed_id` into `follower_id`'s timeline."""
+
+    recent = (db.session
+              .query(literal(follower_id),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .filter(Message.user_id == followed_id)
+              .filter(~(db.session
+                        .query(TimelineEntry)
+                        .filter(TimelineEntry.user_id == follower_id,
+                                TimelineEntry.message_id == Message.id)
+                        .exists()))
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_SIZE))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            TIMELINE_COLUMNS, recent.statement))
+
+
+def user_removed(user_id):
+    """Update counts and fan-out modes before `user_id` is deleted."""
+
+    followed = pulled_author_ids(user_id)
+    User.release_counts(user_id)
+
+    for followed_id in followed:
+        sync_fanout_mode(followed_id)
+
+
+def remove_follow(follower_id, followed_id):
+    """Drop the messages of `followed_id` from `follower_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.author_id == followed_id)
+     .delete(synchronize_session=False))
+
+
+def pulled_author_ids(user_id):
+    """IDs of pulled authors followed by `user_id`."""
+
+    pulled = pulled_authors()
+    if not pulled:
+        return []
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(pulled))
+            .all())
+    return [followed_id for (followed_id,) in rows]
+
+
+def timeline_version(user_id):
+    """(follows version, newest message id) of `user_id`'s home timeline.
+
+    This changes when a message is delivered to the timeline or the user
+    follows or unfollows someone, so it makes a cheap ETag. Deleting a
+    message only changes it if that was the newest one.
+    """
+
+    newest = (db.session
+              .query(db.func.max(TimelineEntry.message_id))
+              .filter(TimelineEntry.user_id == User.id)
+              .as_scalar())
+    follows_version, newest_id = (db.session
+                                  .query(User.follows_version, newest)
+                                  .filter(User.id == user_id)
+                                  .one())
+
+    pulled_ids = pulled_author_ids(user_id)
+    if pulled_ids:
+        newest_pulled = (db.session
+                         .query(db.func.max(Message.id))
+                         .filter(Message.user_id.in_(pulled_ids))
+                         .scalar())
+        newest_id = max(newest_id or 0, newest_pulled or 0)
+
+    return follows_version, newest_id or 0
+
+
+def home_messages(user, limit=100, cursor=None, since_id=None):
+    """Up to `limit` messages on `user`'s home timeline, newest first.
+
+    With a `cursor` (see pagination.py), only messages before it are read;
+    with a `since_id`, only messages with a greater id.
+    """
+
+    inbox = (Message
+             .query
+             .options(joinedload(Message.user))
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == user.id))
+    if since_id is not None:
+        inbox = inbox.filter(TimelineEntry.message_id > since_id)
+    inbox = (before(inbox, TimelineEntry.timestamp, TimelineEntry.message_id,
+                    cursor)
+             .order_by(TimelineEntry.timestamp.desc(),
+                       TimelineEntry.message_id.desc())
+             .limit(limit)
+             .all())
+
+    pulled_ids = pulled_author_ids(user.id)
+    if not pulled_ids:
+        return inbox
+
+    pulled = (Message
+              .query
+              .options(joinedload(Message.user))
+              .filter(Message.user_id.in_(pulled_ids)))
+    if since_id is not None:
+        pulled = pulled.filter(Message.id > since_id)
+    pulled = (before(pulled, Message.timestamp, Message.id, cursor)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit)
+              .all())
+
+    return list(islice(_dedupe(heapq.merge(inbox, pulled, key=_sort_key,
+                                           reverse=True)),
+                       limit))
+
+
+def rebuild_timelines():
+    """Rebuild user counts, fan-out modes and every timeline from
+    `follows` and `messages`.
+
+    Used after bulk loads (seed.py), after changing TIMELINE_FANOUT_LIMIT,
+    and to repair drift.
+    """
+
+    User.reconcile_counts()
+    User.query.update({User.fanout_pulled: User.followers_count > fanout_limit()},
+                      synchronize_session=False)
+    forget_pulled_authors()
+
+    table = TimelineEntry.__table__
+    db.session.execute(table.delete())
+
+    own = db.session.query(Message.user_id,
+                           Message.id,
+                           Message.user_id.label('author_id'),
+                           Message.timestamp)
+    db.session.execute(table.insert().from_select(TIMELINE_COLUMNS,
+                                                  own.statement))
+
+    followed = (db.session
+                .query(Follows.user_following_id,
+                       Message.id,
+                       Message.user_id,
+                       Message.timestamp)
+                .join(Message,
+                      Message.user_id == Follows.user_being_followed_id)
+                .join(User, User.id == Message.user_id)
+                .filter(~User.fanout_pulled,
+                        Follows.user_following_id != Message.user_id))
+    db.session.execute(table.insert().from_select(TIMELINE_COLUMNS,
+                                                  followed.statement))
+
+
+def _set_pulled(user_id, pulled):
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update({User.fanout_pulled: pulled}, synchronize_session=False))
+    forget_pulled_authors()
+
+
+def _backfill_followers(user_id):
+    """Copy `user_id`'s recent messages into all of their followers' inboxes."""
+
+    recent = (db.session
+              .query(Message.id, Message.user_id, Message.timestamp)
+              .filter(Message.user_id == user_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_SIZE)
+              .subquery())
+
+    inbox = aliased(TimelineEntry)
+    rows = (db.session
+            .query(Follows.user_following_id,
+                   recent.c.id,
+                   recent.c.user_id,
+                   recent.c.timestamp)
+            .filter(Follows.user_being_followed_id == user_id,
+                    Follows.user_following_id != user_id)
+            .filter(~(db.session
+                      .query(inbox)
+                      .filter(inbox.user_id == Follows.user_following_id,
+                              inbox.message_id == recent.c.id)
+                      .exists())))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            TIMELINE_COLUMNS, rows.statement))
+
+
+def _sort_key(msg):
+    return (msg.timestamp, msg.id)
+
+
+def _dedupe(messages):
+    seen = set()
+    for msg in messages:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            yield msg